@@ -0,0 +1,504 @@
+import argparse
+import fcntl
+import heapq
+import json
+import os
+import random
+import resource
+import select
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+import tcping
+
+
+SRC_IP = '172.22.90.211'
+DST_IP = '178.248.233.33'
+
+TUNSETIFF = 0x400454ca
+IFF_TUN = 0x0001
+IFF_NO_PI = 0x1000
+
+WINDOWED = ['pipelined', 'connect']
+
+TCP_SYN = 0x02
+TCP_SYN_ACK = 0x12
+
+
+class TunResponder:
+    """
+    Answers TCP SYNs sent to a TUN device with SYN-ACKs after delay
+    seconds, dropping loss share of them. Host side of the device gets
+    prefix.1, every other address in prefix.0/24 is answered by it,
+    so whole benchmark runs on one box without network or namespaces.
+    Needs root and /dev/net/tun.
+    """
+
+    def __init__(self, name='tcpbench0', prefix='10.213.0', delay=0,
+                 loss=0) -> None:
+        self.name = name
+        self.prefix = prefix
+        self.delay = delay
+        self.loss = loss
+
+        self.answered = 0
+        self.dropped = 0
+
+        self.tun = None
+        self.thread = None
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.running = False
+
+    @property
+    def dst_ip(self):
+        return f'{self.prefix}.2'
+
+    def start(self) -> None:
+        self.tun = os.open('/dev/net/tun', os.O_RDWR)
+        fcntl.ioctl(self.tun, TUNSETIFF, struct.pack(
+            '16sH', self.name.encode(), IFF_TUN | IFF_NO_PI))
+
+        subprocess.run(
+            ['ip', 'addr', 'add', f'{self.prefix}.1/24', 'dev', self.name],
+            check=True)
+        subprocess.run(['ip', 'link', 'set', self.name, 'up'], check=True)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        os.write(self.wakeup_w, b'\0')
+        self.thread.join()
+        os.close(self.tun)
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def run(self) -> None:
+        poll = select.poll()
+        poll.register(self.tun, select.POLLIN)
+        poll.register(self.wakeup_r, select.POLLIN)
+        pending = []
+
+        while self.running:
+            timeout = None
+            if pending:
+                timeout = max(0, (pending[0][0] - time.monotonic()) * 1000)
+
+            for fd, _ in poll.poll(timeout):
+                if fd == self.tun:
+                    reply = self.answer(os.read(self.tun, 2048))
+                    if reply is not None:
+                        heapq.heappush(
+                            pending, (time.monotonic() + self.delay, reply))
+
+            now = time.monotonic()
+            while pending and pending[0][0] <= now:
+                os.write(self.tun, heapq.heappop(pending)[1])
+                self.answered += 1
+
+    def answer(self, data):
+        """
+        Returns SYN-ACK for SYN in data, None for anything else
+        (including RSTs kernel sends for our own SYN-ACKs).
+        """
+        if len(data) < 40 or data[0] >> 4 != 4 or data[9] != 6:
+            return None
+
+        ihl = (data[0] & 0x0f) * 4
+        src_port, dst_port, seq_num, _, _, flags = struct.unpack_from(
+            '!HHIIBB', data, ihl)
+        if flags != TCP_SYN:
+            return None
+
+        if self.loss and random.random() < self.loss:
+            self.dropped += 1
+            return None
+
+        src_ip, dst_ip = data[16:20], data[12:16]
+        tcp_header = bytearray(struct.pack(
+            '!HHIIBBHHH', dst_port, src_port, random.getrandbits(32),
+            (seq_num + 1) & 0xffffffff, 80, TCP_SYN_ACK, 2048, 0, 0))
+        pshdr = struct.pack(
+            '!4s4sHH', src_ip, dst_ip, socket.IPPROTO_TCP, len(tcp_header))
+        struct.pack_into(
+            'H', tcp_header, 16, tcping.get_checksum(
+                bytes(pshdr + tcp_header)))
+
+        ip_header = bytearray(struct.pack(
+            '!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp_header), 0, 0, 64,
+            socket.IPPROTO_TCP, 0, src_ip, dst_ip))
+        struct.pack_into(
+            'H', ip_header, 10, tcping.get_checksum(bytes(ip_header)))
+
+        return bytes(ip_header + tcp_header)
+
+
+def rss_kb():
+    """
+    Returns current resident set size of this process in kB.
+    """
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+
+def bench_session(path, count, interval=0.001, delay=0.001, loss=0, window=1,
+                  timeout=0.5, debug_stats=False):
+    """
+    Runs one tcping session of count probes through path ('raw',
+    'pipelined', 'connect' or 'scapy') against TunResponder and returns
+    machine-readable results: probes per second, CPU per probe,
+    RSS growth and RTT overhead (measured RTT minus responder delay).
+    With debug_stats per-stage timers of the session are added.
+    """
+    with TunResponder(delay=delay, loss=loss) as responder:
+        if path == 'scapy':
+            from scapy.all import conf
+            conf.route.resync()
+
+        session = tcping.Session(
+            responder.dst_ip, 80, count, timeout, interval, window,
+            output=tcping.MemoryWriter(), debug_stats=debug_stats)
+        session.dst_ip = tcping.get_dst_ip(responder.dst_ip)
+
+        rss_before = rss_kb()
+        cpu_time = time.process_time()
+        init_time = time.monotonic()
+
+        getattr(session, 'run_' + path)()
+
+        elapsed = time.monotonic() - init_time
+        cpu_time = time.process_time() - cpu_time
+        rss_after = rss_kb()
+
+    stat = session.stat
+    delay_us = round(delay * 1000000)
+    overhead = (lambda us: -1 if us == -1 else us - delay_us)
+    res = {
+        'path': path,
+        'count': count,
+        'interval': interval,
+        'window': window,
+        'delay_us': delay_us,
+        'loss': loss,
+        'sent': stat.send,
+        'received': stat.recv,
+        'dropped': responder.dropped,
+        'elapsed_s': round(elapsed, 6),
+        'pps': round(stat.send / elapsed, 1) if elapsed else 0,
+        'cpu_us_per_probe': round(cpu_time * 1000000 / max(stat.send, 1), 1),
+        'overhead_p50_us': overhead(stat.get_percentile(50)),
+        'overhead_p99_us': overhead(stat.get_percentile(99)),
+        'rss_kb': rss_after,
+        'rss_growth_kb': rss_after - rss_before,
+    }
+    if session.stages is not None:
+        res['stages'] = session.stages.as_dict()
+    return res
+
+
+def bench_stats_overhead(ports, window=1000, interval=0.00001, timeout=1,
+                         repeat=11):
+    """
+    Sweeps closed ports 1..ports of loopback without stage stats, with
+    default sampled ones and with every iteration timed, rotating runs.
+    Overhead is the median of differences between adjacent runs, which
+    is steadier than CPU time of single runs. Sweep is run in process,
+    so CPU of the kernel answering SYNs is counted too, like in a real
+    sweep.
+    """
+    def run(stages):
+        targets = (('127.0.0.1', port) for port in range(1, ports + 1))
+        init_time = time.process_time()
+        for _ in tcping.sweep(targets, timeout, interval, window,
+                              stages=stages):
+            pass
+        return (time.process_time() - init_time) / ports * 1e6
+
+    configs = {
+        'off': lambda: None,
+        'sampled': tcping.StageStats,
+        'every': lambda: tcping.StageStats(sample_every=1),
+    }
+    cpu = {name: [] for name in configs}
+    for _ in range(repeat):
+        for name, make in configs.items():
+            cpu[name].append(run(make()))
+
+    off = statistics.median(cpu['off'])
+    res = {'probes': ports, 'cpu_us_per_probe_off': round(off, 2)}
+    for name in ['sampled', 'every']:
+        overhead = statistics.median(
+            on - base for on, base in zip(cpu[name], cpu['off']))
+        res[f'overhead_{name}_us'] = round(overhead, 3)
+        res[f'overhead_{name}_pct'] = round(100 * overhead / off, 2)
+    return res
+
+
+def bench_form_packet(number):
+    """
+    Compares building SYN packets with form_packet and SynTemplate.
+    Returns packets per second for both ways.
+    """
+    seqs = [random.randint(0, 1234567) for _ in range(number)]
+    template = tcping.SynTemplate(SRC_IP, 49155, DST_IP, 80)
+
+    def full():
+        for seq_num in seqs:
+            tcping.form_packet(SRC_IP, 49155, DST_IP, 80, seq_num, 2)
+
+    def patched():
+        for seq_num in seqs:
+            template.packet(seq_num)
+
+    return {
+        'form_packet': number / min(timeit.repeat(full, number=1, repeat=5)),
+        'syn_template': number / min(
+            timeit.repeat(patched, number=1, repeat=5)),
+    }
+
+
+def unpack_copying(data):
+    """
+    Reply parsing as it was before recv_into: fixed 20-byte IP header,
+    slice copy and format string parsed on every call.
+    """
+    src_port, _, _, ack_num, _, flags = struct.unpack(
+        '!HHIIBB', data[20:34])
+    return socket.inet_ntoa(data[12:16]), src_port, ack_num, flags
+
+
+def bench_recv(number, batch=2000, repeat=5):
+    """
+    Compares receive and parse of replies: recv() with slicing and
+    struct.unpack by format string against recv_into() preallocated
+    buffer with unpack_reply() (Struct.unpack_from at IHL offset).
+    Replies (IPv4 + TCP SYN-ACK) are queued on loopback UDP socket
+    in batches, only draining is timed, best of repeat runs is taken.
+    Parsing alone is measured too. Returns packets per second.
+    """
+    reply = bytes([0x45]) + bytes(11) + socket.inet_aton(DST_IP) + \
+        socket.inet_aton(SRC_IP) + struct.pack(
+            '!HHIIBBHHH', 80, 49155, 1, 2, 80, 0x12, 2048, 0, 0)
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tcping.set_rcvbuf(receiver)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.setblocking(False)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = receiver.getsockname()
+    buf = memoryview(bytearray(2048))
+
+    def copying():
+        while True:
+            try:
+                data = receiver.recv(2048)
+            except BlockingIOError:
+                return
+            time.monotonic_ns()
+            unpack_copying(data)
+
+    def zero_copy():
+        while True:
+            try:
+                data, _, _ = tcping.recv_reply(receiver, False, buf)
+            except BlockingIOError:
+                return
+            tcping.unpack_reply(data)
+
+    def run(drain):
+        elapsed = 0
+        for _ in range(0, number, batch):
+            for _ in range(batch):
+                sender.sendto(reply, address)
+            init_time = time.perf_counter()
+            drain()
+            elapsed += time.perf_counter() - init_time
+        return number / elapsed
+
+    res = {}
+    for name, drain in [('recv_unpack', copying), ('recv_into', zero_copy)]:
+        res[name] = max(run(drain) for _ in range(repeat))
+
+    view = memoryview(bytearray(reply))
+    for name, parse in [('parse_unpack', lambda: unpack_copying(reply)),
+                        ('parse_unpack_from',
+                         lambda: tcping.unpack_reply(view))]:
+        res[name] = number / min(
+            timeit.repeat(parse, number=number, repeat=repeat))
+
+    sender.close()
+    receiver.close()
+    return res
+
+
+def bench_sweep(ring, ports, window=1000, interval=0.00001, timeout=1,
+                workers=1):
+    """
+    Sweeps closed ports 1..ports of loopback (kernel answers every SYN
+    with RST at once), reading replies from raw socket or PacketRing,
+    in one process or sharded across workers processes.
+    Returns probes per second and number of answered probes.
+    """
+    writer = tcping.MemoryWriter()
+    init_time = time.monotonic()
+    tcping.start_sweep('127.0.0.1', [(1, ports)], timeout, interval, window,
+                       output=writer, mode=tcping.MODE_RAW, ring=ring,
+                       workers=workers)
+    elapsed = time.monotonic() - init_time
+    return {
+        'backend': 'ring' if ring else 'raw',
+        'workers': workers,
+        'probes': ports,
+        'answered': sum(1 for res in writer.results if res.rtt is not None),
+        'elapsed_s': round(elapsed, 6),
+        'pps': round(ports / elapsed, 1),
+    }
+
+
+def bench_import(repeat=5):
+    """
+    Measures cold import of tcping in fresh interpreters and returns
+    the best time in seconds with modules it pulled in, so heavy
+    optional ones (scapy, texttable) can be checked too.
+    """
+    code = ('import sys, time; init_time = time.perf_counter(); ' +
+            'import tcping; print(time.perf_counter() - init_time); ' +
+            'print(*sys.modules)')
+
+    best, modules = None, None
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed, names = out.stdout.split('\n', 1)
+        if best is None or float(elapsed) < best:
+            best = float(elapsed)
+        modules = set(names.split())
+    return best, modules
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks for tcping hot paths')
+    parser.add_argument(
+        '-n',
+        '--number',
+        type=int,
+        default=100000,
+        help='Number of iterations per run')
+    parser.add_argument(
+        '--session',
+        nargs='+',
+        choices=['raw', 'pipelined', 'connect', 'scapy'],
+        help='Run whole sessions against local TUN responder '
+             'and print results as JSON')
+    parser.add_argument(
+        '-c',
+        '--count',
+        type=int,
+        default=1000,
+        help='Number of probes per session')
+    parser.add_argument(
+        '-i',
+        '--interval',
+        type=float,
+        default=0.001,
+        help='Interval between probes of session')
+    parser.add_argument(
+        '-w',
+        '--window',
+        type=int,
+        default=16,
+        help='Probes in flight for pipelined session')
+    parser.add_argument(
+        '--delay',
+        type=float,
+        default=0.001,
+        help='Responder delay before SYN-ACK, in seconds')
+    parser.add_argument(
+        '--loss',
+        type=float,
+        default=0,
+        help='Share of SYNs responder drops, from 0 to 1')
+    parser.add_argument(
+        '--recv',
+        action='store_true',
+        help='Compare copying and recv_into receive paths')
+    parser.add_argument(
+        '--sweep',
+        type=int,
+        metavar='PORTS',
+        help='Sweep that many closed loopback ports with raw socket and ' +
+             'PACKET_MMAP ring receive backends, print results as JSON')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        nargs='+',
+        default=[1],
+        help='Numbers of sweep worker processes to compare')
+    parser.add_argument(
+        '--import-budget',
+        type=float,
+        help='Measure import time of tcping and fail if it takes more ' +
+             'seconds than this or imports scapy or texttable')
+    parser.add_argument(
+        '--debug-stats',
+        action='store_true',
+        help='Add per-stage timers of sessions to results')
+    parser.add_argument(
+        '--stats-overhead',
+        action='store_true',
+        help='With --sweep, compare CPU per probe of sweeps without ' +
+             'stage stats, with sampled and with full stage timers')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.recv:
+        for name, pps in bench_recv(args.number).items():
+            print(f'{name}: {round(pps)} packets/s')
+    elif args.import_budget is not None:
+        elapsed, modules = bench_import()
+        heavy = sorted({'scapy', 'texttable'} & modules)
+        print(f'import tcping: {elapsed * 1000:.1f}ms ' +
+              f'(budget {args.import_budget * 1000:.1f}ms)')
+        if heavy:
+            print(f'Eagerly imported: {", ".join(heavy)}')
+        if heavy or elapsed > args.import_budget:
+            sys.exit(1)
+    elif args.sweep and args.stats_overhead:
+        print(json.dumps(bench_stats_overhead(args.sweep, args.window),
+                         indent=2))
+    elif args.sweep:
+        results = [bench_sweep(ring, args.sweep, args.window,
+                               workers=workers)
+                   for workers in args.workers for ring in (False, True)]
+        print(json.dumps(results, indent=2))
+    elif args.session:
+        results = [
+            bench_session(path, args.count, args.interval, args.delay,
+                          args.loss, args.window if path in WINDOWED else 1,
+                          debug_stats=args.debug_stats)
+            for path in args.session
+        ]
+        print(json.dumps(results, indent=2))
+    else:
+        for name, pps in bench_form_packet(args.number).items():
+            print(f'{name}: {round(pps)} packets/s')
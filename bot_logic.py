@@ -1,4 +1,6 @@
+import io
 import signal
+import socket
 from threading import Thread, current_thread
 from threading import Event
 from time import sleep
@@ -6,9 +8,9 @@ import telebot
 from telebot.types import InlineKeyboardButton,\
     InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 import tcping
+import bot_tools
 import sys
 import os
-import re
 
 from subprocess import Popen, PIPE, STDOUT
 
@@ -23,7 +25,7 @@ from subprocess import Popen, PIPE, STDOUT
 │         (Got response)                               │
 │               ↓                                      │
 │              ┌─────────────┐                         │
-│       ┌─────>│ state_files │                         │
+│       ┌─────>│ host_states │                         │
 │       │      └─────────────┘                         │
 │ ┌─────┴──┐                                           │
 │ │ Daemon │                                           │
@@ -47,89 +49,89 @@ class StoppableThread(Thread):
 
 
 class WatchDog:
-    def __init__(self) -> None:
+    def __init__(self, history_dir, send) -> None:
         self.wd_online = False
         self.survey_time = 1
 
         self.hosts = []
-        self.TCPing_daemons = []
+        self.engine = None
         self.WDaemon = None
 
         self.tcping_timeout = 1
         self.tcping_interval = 1
 
+        self.history = bot_tools.RttHistory(history_dir)
+        self.notifier = bot_tools.Notifier(send)
+
     def start_watcher(self) -> None:
         self.wd_online = True
+        self.notifier.start()
         self.WDaemon = StoppableThread(target=self.watcher, args=(self.hosts,))
         self.WDaemon.start()
 
     def stop_watcher(self) -> None:
         if self.WDaemon is not None:
             self.WDaemon.stop()
+        self.notifier.stop(self.survey_time)
 
     def watcher(self, hosts) -> None:
-        cur_state = {}
-        prev_state = {}
         while (True):
             if current_thread().stopped():
                 print('Watcher was stopped')
                 break
 
-            for host in hosts:
-                dst_ip = tcping.get_dst_ip(host)
+            transitions = tcping.wd_states.wait_transitions(self.survey_time)
+            for (host, port), prev_state, cur_state in transitions:
+                if prev_state is None:
+                    if cur_state:
+                        msg = f'Host {host}:{port} is online already'
+                        self.notifier.notify(bot_conf.chat_id, msg)
 
-                if prev_state.get(dst_ip) is None:
-                    with open(f'{dst_ip}.txt', 'r') as fh:
-                        state = fh.read()
-                        prev_state[dst_ip] = state
-                    if prev_state[dst_ip] == "1":
-                        msg = f'Host {dst_ip} is online already'
-                        bot.send_message(bot_conf.chat_id, msg)
+                elif cur_state:
+                    self.notifier.notify(
+                        bot_conf.chat_id, f'Host: {host}:{port} is online now')
 
                 else:
+                    self.notifier.notify(
+                        bot_conf.chat_id,
+                        f'Host: {host}:{port} is offline now')
+
+    def add_tcping_daemon(self, host, port) -> bool:
+        if self.engine is None:
+            try:
+                self.engine = tcping.ProbeEngine(self.tcping_timeout)
+            except OSError as e:
+                bot.send_message(
+                    bot_conf.chat_id, f'Unable to start Watch Dog: {e}')
+                return False
+            self.engine.start()
+
+        try:
+            self.engine.add_target(
+                host, port, self.tcping_interval, self.tcping_timeout,
+                self.save_probe_result)
+        except ValueError as e:
+            bot.send_message(bot_conf.chat_id, f'Can\'t watch {host}: {e}')
+            return False
+        except socket.gaierror:
+            bot.send_message(
+                bot_conf.chat_id, f'Can\'t get IP address for {host}')
+            return False
+        except OSError as e:
+            bot.send_message(bot_conf.chat_id, f'Can\'t watch {host}: {e}')
+            return False
+
+        self.hosts.append((host, port))
+        return True
 
-                    if os.path.isfile(f'{dst_ip}.txt'):
-                        with open(f'{dst_ip}.txt', 'r') as fh:
-                            state = fh.read()
-                            cur_state[dst_ip] = state
-
-                    if cur_state[dst_ip] == "1" and prev_state[dst_ip] == "0":
-                        prev_state[dst_ip] = '1'
-                        bot.send_message(
-                            bot_conf.chat_id, f'Host: {dst_ip} is online now')
-
-                    elif prev_state[dst_ip] == "1" and \
-                            cur_state[dst_ip] == '0':
-                        prev_state[dst_ip] = '0'
-                        bot.send_message(
-                            bot_conf.chat_id, f'Host: {dst_ip} is offline now')
-            sleep(self.survey_time)
-
-    def add_tcping_daemon(self, host, port) -> None:
-        dst_ip = tcping.get_dst_ip(host)
-        with open(f'{dst_ip}.txt', 'w') as fh:
-            fh.write('0')
-
-        self.hosts.append(bot_conf.host)
-        interval = self.tcping_interval
-        timeout = self.tcping_timeout
-
-        thread = StoppableThread(
-            target=tcping.start_tcping_session,
-            args=(host, port, sys.maxsize, timeout, interval, True))
-        self.TCPing_daemons.append(thread)
-
-        thread.start()
-
-    def remove_stat_files(self) -> None:
-        files = os.listdir('.')
-        for file in files:
-            if re.search(r'\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3}', file):
-                os.remove(file)
+    def save_probe_result(self, target, seq_num, delta, state) -> None:
+        tcping.wd_states.publish((target.host, target.port),
+                                 state == tcping.PORT_OPEN)
+        self.history.add(target.host, target.port, delta, state)
 
     def stop_daemons(self) -> None:
-        for daemon in self.TCPing_daemons:
-            daemon.stop()
+        if self.engine is not None:
+            self.engine.stop()
 
 
 class BotConfig:
@@ -144,6 +146,10 @@ class BotConfig:
         self.timeout = 0.5
         self.interval = 0.5
 
+        self.history_dir = 'tcping_history'
+        self.session_workers = 4
+        self.max_sessions = 16
+
         self.chat_id = None
 
 
@@ -154,7 +160,10 @@ authorized = False
 watch_dog_started = False
 
 bot = telebot.TeleBot(bot_conf.bot_token)
-watch_dog = WatchDog()
+watch_dog = WatchDog(bot_conf.history_dir, bot.send_message)
+session_pool = bot_tools.SessionPool(bot_conf.session_workers,
+                                     bot_conf.max_sessions,
+                                     progress_interval=2)
 
 
 def generate_inline_keys():
@@ -173,10 +182,12 @@ def sigint_handler(signal, frame):
     print('Started graceful shutdown')
 
     watch_dog.stop_daemons()
+    session_pool.shutdown()
     sleep(watch_dog.tcping_interval + watch_dog.tcping_timeout)
 
-    watch_dog.remove_stat_files()
+    tcping.wd_states.clear()
     watch_dog.stop_watcher()
+    watch_dog.history.close()
 
     print('Done!')
     sys.exit(0)
@@ -216,7 +227,11 @@ def help_command(message):
             '/count $new_val\n' +
             '/interval $new_val\n' +
             '/port $new_val\n' +
-            '/update - Updates list of hosts for Watch Dog',
+            '/update - Updates list of hosts for Watch Dog\n' +
+            '/cancel $job_id - Stops tcping session\n' +
+            '/history $host[:$port] [$range] - RTT trend of Watch Dog ' +
+            'host (every watched port of it without $port) for range ' +
+            'like 30m, 6h or 7d (default 1h)',
             reply_markup=keyboard
         )
     else:
@@ -248,11 +263,11 @@ def act_wd(message):
             bot_conf.chat_id = message.chat.id
 
             watch_dog.start_watcher()
-            watch_dog.add_tcping_daemon(bot_conf.host, bot_conf.port)
-            bot.send_message(
-                message.chat.id,
-                'Watch Dog was successfully started ' +
-                f'and now looking for {bot_conf.host}')
+            if watch_dog.add_tcping_daemon(bot_conf.host, bot_conf.port):
+                bot.send_message(
+                    message.chat.id,
+                    'Watch Dog was successfully started ' +
+                    f'and now looking for {bot_conf.host}')
     else:
         send_reject_msg(message)
 
@@ -357,15 +372,62 @@ def update(message):
             bot.send_message(message.chat.id,
                              'You have to start Watch Dog before using Update')
         else:
-            if bot_conf.host not in watch_dog.hosts:
-                watch_dog.add_tcping_daemon(bot_conf.host, bot_conf.port)
-                bot.send_message(
-                    message.chat.id,
-                    f'Watch Dog is now looking for {bot_conf.host}')
+            target = (bot_conf.host, bot_conf.port)
+            if target not in watch_dog.hosts:
+                if watch_dog.add_tcping_daemon(*target):
+                    bot.send_message(
+                        message.chat.id,
+                        'Watch Dog is now looking for ' +
+                        f'{bot_conf.host}:{bot_conf.port}')
             else:
                 bot.send_message(
                     message.chat.id,
-                    'You have already added this host to Watch Dog')
+                    'You have already added this host and port to Watch Dog')
+    else:
+        send_reject_msg(message)
+
+
+@bot.message_handler(commands=['cancel'])
+def cancel_session(message):
+    if authorized:
+        job_id = validate_and_get(message)
+        if job_id is None:
+            return
+        if job_id.isdigit() and session_pool.cancel(int(job_id)):
+            bot.send_message(message.chat.id, f'Cancelling job #{job_id}')
+        else:
+            bot.send_message(message.chat.id,
+                             f'There is no running job #{job_id}')
+    else:
+        send_reject_msg(message)
+
+
+@bot.message_handler(commands=['history'])
+def send_history(message):
+    if authorized:
+        args = message.text.split(' ')
+        if len(args) not in [2, 3]:
+            bot.send_message(
+                message.chat.id,
+                'Usage: /history $host[:$port] [$range], ' +
+                'e.g. /history habr.ru:443 7d')
+            return
+
+        try:
+            seconds = bot_tools.parse_duration(
+                args[2] if len(args) == 3 else '1h')
+        except ValueError as e:
+            bot.send_message(message.chat.id, f'{e}, use e.g. 30m, 6h, 7d')
+            return
+
+        host, port = bot_tools.parse_target(args[1])
+        ports = watch_dog.history.ports(host) if port is None else [port]
+        reports = [watch_dog.history.report(host, port, seconds)
+                   for port in ports]
+        reports = [report for report in reports if report is not None]
+        if not reports:
+            reports = [f'Watch Dog has no history of {args[1]}']
+        bot.send_message(message.chat.id, '\n\n'.join(reports))
     else:
         send_reject_msg(message)
 
@@ -404,24 +466,30 @@ def start_session(query):
 
 
 def send_results(message):
-    init_stdout = sys.stdout
-
-    sys.stdout = open('tcping.log', 'w')
-    tcping.start_tcping_session(
-        bot_conf.host,
-        bot_conf.port,
-        bot_conf.count,
-        bot_conf.timeout,
-        bot_conf.interval,
-        False)
-    sys.stdout.close()
-
-    sys.stdout = init_stdout
-
-    bot.send_chat_action(message.chat.id, 'upload_document')
-    with open('tcping.log', 'rb') as file:
-        bot.send_document(chat_id=message.chat.id, document=file)
-    os.remove('tcping.log')
+    status = bot.send_message(message.chat.id, 'Starting tcping session...')
+
+    def progress(job):
+        text = job.describe()
+        if not job.finished:
+            text += f'\n\n/cancel {job.id}'
+        try:
+            bot.edit_message_text(text, message.chat.id, status.message_id)
+        except Exception as e:  # e.g. message is not modified
+            print(f'Unable to update progress of job #{job.id}: {e}')
+
+        if job.state in [bot_tools.JOB_DONE, bot_tools.JOB_CANCELLED]:
+            document = io.BytesIO(job.log.getvalue().encode())
+            document.name = f'tcping_{job.id}.log'
+            bot.send_document(chat_id=message.chat.id, document=document)
+
+    job = session_pool.submit(bot_conf.host, bot_conf.port, bot_conf.count,
+                              bot_conf.timeout, bot_conf.interval, progress)
+    if job is None:
+        bot.edit_message_text(
+            'Too many tcping sessions are running, try again later',
+            message.chat.id, status.message_id)
+    elif job.state == bot_tools.JOB_QUEUED:
+        progress(job)
 
 
 def start_watch_dog(query):
@@ -441,12 +509,11 @@ def start_watch_dog(query):
             bot_conf.chat_id = query.message.chat.id
 
             watch_dog.start_watcher()
-            watch_dog.add_tcping_daemon(bot_conf.host, bot_conf.port)
-
-            bot.send_message(
-                query.message.chat.id,
-                'Watch Dog was successfully started ' +
-                f'and now looking for {bot_conf.host}')
+            if watch_dog.add_tcping_daemon(bot_conf.host, bot_conf.port):
+                bot.send_message(
+                    query.message.chat.id,
+                    'Watch Dog was successfully started ' +
+                    f'and now looking for {bot_conf.host}')
     else:
         send_reject_query(query)
 
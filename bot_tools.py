@@ -0,0 +1,619 @@
+import collections
+import io
+import itertools
+import math
+import mmap
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Event, Lock, Thread
+
+import tcping
+
+
+PORT_STATES = [tcping.PORT_OPEN, tcping.PORT_CLOSED, tcping.PORT_FILTERED,
+               tcping.PORT_UNREACHABLE]
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_CANCELLED = 'cancelled'
+JOB_FAILED = 'failed'
+
+
+def parse_duration(text):
+    """
+    Parses duration like 90s, 30m, 6h, 7d or 1w into seconds.
+    """
+    try:
+        seconds = int(text[:-1]) * DURATION_UNITS[text[-1:].lower()]
+    except (ValueError, KeyError):
+        raise ValueError(f'Invalid duration: {text}')
+    if seconds <= 0:
+        raise ValueError(f'Invalid duration: {text}')
+    return seconds
+
+
+def parse_target(text):
+    """
+    Splits host[:port] into (host, port), port is None if not given.
+    IPv6 address with port has to be in brackets, like [::1]:53.
+    """
+    host, sep, port = text.rpartition(':')
+    if not sep or not port.isdigit() or ':' in host and \
+            not (host.startswith('[') and host.endswith(']')):
+        return text.strip('[]'), None
+    return host.strip('[]'), int(port)
+
+
+def retry_after(error):
+    """
+    Returns seconds to wait told by rate-limited Bot API error
+    (parameters.retry_after of its JSON), None if it doesn't tell.
+    """
+    result = getattr(error, 'result_json', None)
+    if isinstance(result, dict):
+        return result.get('parameters', {}).get('retry_after')
+    return getattr(error, 'retry_after', None)
+
+
+class Notifier:
+    """
+    Background dispatcher of WatchDog alerts. notify() only queues
+    text, sender thread joins texts for the same chat which come within
+    window seconds into one message (split by max_length), keeps
+    interval seconds between sends and retries failed ones after
+    retry_after told by API or exponential backoff, up to max_retries
+    times. So slow or rate-limited API never blocks the watcher.
+    """
+
+    max_length = 4096
+
+    def __init__(self, send, window=1.0, interval=1.0, max_backoff=60,
+                 max_retries=5) -> None:
+        self.send = send
+        self.window = window
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+
+        self.pending = {}
+        self.first_at = None
+        self.next_send = 0
+        self.cond = Condition()
+        self.stopped = False
+        self.abort = Event()
+        self.thread = None
+
+        self.queued = 0
+        self.sent = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None) -> None:
+        """
+        Sends what is queued and stops sender thread. Texts which
+        are not sent in timeout seconds are dropped.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.abort.set()
+
+    def notify(self, chat_id, text) -> None:
+        with self.cond:
+            if not self.pending:
+                self.first_at = time.monotonic()
+            self.pending.setdefault(chat_id, []).append(text)
+            self.queued += 1
+            self.cond.notify_all()
+
+    def take(self):
+        """
+        Waits for texts and window after the first of them, returns
+        them as {chat_id: [text, ...]}, None once stopped and drained.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending or self.stopped)
+            if not self.pending:
+                return None
+            self.cond.wait_for(
+                lambda: self.stopped,
+                self.first_at + self.window - time.monotonic())
+            batch, self.pending = self.pending, {}
+            return batch
+
+    def run(self) -> None:
+        while True:
+            batch = self.take()
+            if batch is None:
+                return
+            for chat_id, texts in batch.items():
+                for message in self.split(texts):
+                    self.deliver(chat_id, message)
+
+    def split(self, texts) -> list:
+        messages = []
+        for text in texts:
+            text = text[:self.max_length]
+            if messages and \
+                    len(messages[-1]) + 1 + len(text) <= self.max_length:
+                messages[-1] += '\n' + text
+            else:
+                messages.append(text)
+        return messages
+
+    def deliver(self, chat_id, message) -> None:
+        backoff = self.interval
+        for _ in range(self.max_retries + 1):
+            if self.abort.wait(max(0, self.next_send - time.monotonic())):
+                break
+            try:
+                self.send(chat_id, message)
+            except Exception as e:  # any Bot API or network failure
+                self.errors += 1
+                delay = retry_after(e)
+                if delay is None:
+                    delay, backoff = backoff, min(backoff * 2,
+                                                  self.max_backoff)
+                self.next_send = time.monotonic() + delay
+                continue
+
+            self.sent += 1
+            self.next_send = time.monotonic() + self.interval
+            return
+        self.dropped += 1
+
+
+class RttRing:
+    """
+    Fixed-size RTT history of single target in memory-mapped file:
+    ring of the last raw_slots (timestamp, rtt_us, state) samples plus
+    minute and hour rollups (probes, open ones, RTT min / max / sum).
+    Rollup of period n lives in slot n % slots and is reset when
+    a newer period takes the slot, so samples are downsampled as they
+    are added and the file never grows. Not thread-safe.
+    """
+
+    magic = b'RTT1'
+    header = struct.Struct('<4sIIIQ')   # magic, raw / minute / hour slots,
+                                        # samples added
+    sample = struct.Struct('<dIB3x')    # timestamp, rtt_us, state index
+    rollup = struct.Struct('<IIIIIQ')   # period, probes, open, rtt_min,
+                                        # rtt_max, rtt_sum
+    periods = [60, 3600]
+
+    def __init__(self, path, raw_slots=4096, minute_slots=7 * 24 * 60,
+                 hour_slots=90 * 24) -> None:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            magic, *slots, _ = self.header.unpack(
+                os.pread(fd, self.header.size, 0).ljust(self.header.size,
+                                                        b'\0'))
+            is_new = magic != self.magic
+            if is_new:
+                slots = [raw_slots, minute_slots, hour_slots]
+            self.raw_slots, minute_slots, hour_slots = slots
+
+            self.raw_offset = self.header.size
+            minute_offset = self.raw_offset + \
+                self.raw_slots * self.sample.size
+            hour_offset = minute_offset + minute_slots * self.rollup.size
+            size = hour_offset + hour_slots * self.rollup.size
+            if is_new:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.rollups = [(minute_offset, minute_slots),
+                        (hour_offset, hour_slots)]
+        if is_new:
+            self.header.pack_into(self.map, 0, self.magic, *slots, 0)
+
+    @property
+    def added(self) -> int:
+        return self.header.unpack_from(self.map)[-1]
+
+    def add(self, timestamp, rtt, state) -> None:
+        rtt = int(rtt or 0)
+        added = self.added
+        self.sample.pack_into(
+            self.map,
+            self.raw_offset + added % self.raw_slots * self.sample.size,
+            timestamp, rtt, PORT_STATES.index(state))
+        struct.pack_into('<Q', self.map, self.header.size - 8, added + 1)
+
+        is_open = state == tcping.PORT_OPEN
+        for period_len, (offset, slots) in zip(self.periods, self.rollups):
+            period = int(timestamp // period_len)
+            pos = offset + period % slots * self.rollup.size
+            last, probes, opened, rtt_min, rtt_max, rtt_sum = \
+                self.rollup.unpack_from(self.map, pos)
+            if last != period:
+                probes, opened, rtt_min, rtt_max, rtt_sum = 0, 0, 0, 0, 0
+
+            probes += 1
+            if is_open:
+                rtt_min = rtt if opened == 0 else min(rtt_min, rtt)
+                rtt_max = max(rtt_max, rtt)
+                rtt_sum += rtt
+                opened += 1
+            self.rollup.pack_into(self.map, pos, period, probes, opened,
+                                  rtt_min, rtt_max, rtt_sum)
+
+    def samples(self) -> list:
+        """
+        Returns kept raw samples as (timestamp, rtt_us, state),
+        oldest first. rtt_us is None for filtered probes.
+        """
+        added = self.added
+        res = []
+        for index in range(max(0, added - self.raw_slots), added):
+            timestamp, rtt, state = self.sample.unpack_from(
+                self.map,
+                self.raw_offset + index % self.raw_slots * self.sample.size)
+            state = PORT_STATES[state]
+            if state == tcping.PORT_FILTERED:
+                rtt = None
+            res.append((timestamp, rtt, state))
+        return res
+
+    def periods_between(self, period_len, first, last) -> list:
+        """
+        Returns (period start, probes, open, rtt_min, rtt_max, rtt_sum)
+        rollups of period_len seconds (60 or 3600) for periods from
+        first to last timestamp, ones without probes are skipped.
+        """
+        offset, slots = self.rollups[self.periods.index(period_len)]
+        first_period = max(int(first // period_len),
+                           int(last // period_len) - slots + 1)
+        res = []
+        for period in range(first_period, int(last // period_len) + 1):
+            rollup = self.rollup.unpack_from(
+                self.map, offset + period % slots * self.rollup.size)
+            if rollup[0] == period and rollup[1]:
+                res.append((period * period_len,) + rollup[1:])
+        return res
+
+    def close(self) -> None:
+        self.map.flush()
+        self.map.close()
+
+
+class RttHistory:
+    """
+    Thread-safe RTT history of WatchDog targets, one RttRing file per
+    (host, port) in directory. Reports are built from minute rollups for
+    ranges up to max_minutes_range seconds and from hour rollups beyond
+    that, so they take milliseconds even for a week of history.
+    Every open ring holds a mapped file, so at most max_open of them
+    are kept open, least recently used one is closed first.
+    """
+
+    max_minutes_range = 6 * 3600
+
+    def __init__(self, directory, max_open=128, **ring_args) -> None:
+        self.directory = directory
+        self.ring_args = ring_args
+        self.max_open = max_open
+        self.rings = collections.OrderedDict()
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def file_prefix(host) -> str:
+        return ''.join(
+            c if c.isalnum() or c in '.-' else '_' for c in host) + '_'
+
+    def path(self, host, port) -> str:
+        return os.path.join(self.directory,
+                            f'{self.file_prefix(host)}{port}.rtt')
+
+    def ring(self, host, port, create=True):
+        ring = self.rings.get((host, port))
+        if ring is not None:
+            self.rings.move_to_end((host, port))
+        elif create or os.path.exists(self.path(host, port)):
+            if len(self.rings) >= self.max_open:
+                self.rings.popitem(last=False)[1].close()
+            ring = RttRing(self.path(host, port), **self.ring_args)
+            self.rings[(host, port)] = ring
+        return ring
+
+    def ports(self, host) -> list:
+        """
+        Returns sorted ports of host which have history.
+        """
+        prefix = self.file_prefix(host)
+        ports = set()
+        for name in os.listdir(self.directory):
+            port = name[len(prefix):-len('.rtt')]
+            if name.startswith(prefix) and name.endswith('.rtt') and \
+                    port.isdigit():
+                ports.add(int(port))
+        return sorted(ports)
+
+    def add(self, host, port, rtt, state, timestamp=None) -> None:
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            self.ring(host, port).add(timestamp, rtt, state)
+
+    def rollups(self, host, port, seconds, rows=12, now=None):
+        """
+        Merges rollups of last seconds into up to rows buckets of equal
+        length, returns list of (bucket start, probes, open, rtt_min,
+        rtt_max, rtt_sum), or None if there is no history of host:port.
+        """
+        now = time.time() if now is None else now
+        period_len = 60 if seconds <= self.max_minutes_range else 3600
+        count = math.ceil(seconds / period_len)
+        first = (int(now // period_len) - count + 1) * period_len
+        with self.lock:
+            ring = self.ring(host, port, create=False)
+            if ring is None:
+                return None
+            periods = ring.periods_between(period_len, first, now)
+
+        bucket_len = math.ceil(count / rows) * period_len
+        buckets = {}
+        for start, probes, opened, rtt_min, rtt_max, rtt_sum in periods:
+            bucket = first + (start - first) // bucket_len * bucket_len
+            if bucket not in buckets:
+                buckets[bucket] = [bucket, 0, 0, rtt_min, rtt_max, 0]
+            res = buckets[bucket]
+            if opened:
+                res[3] = rtt_min if res[2] == 0 else min(res[3], rtt_min)
+                res[4] = max(res[4], rtt_max)
+            res[1] += probes
+            res[2] += opened
+            res[5] += rtt_sum
+        return [tuple(buckets[bucket]) for bucket in sorted(buckets)]
+
+    def report(self, host, port, seconds, rows=12, now=None):
+        """
+        Returns text report of host:port RTT trend for last seconds,
+        or None if there is no history of host:port.
+        """
+        buckets = self.rollups(host, port, seconds, rows, now)
+        if buckets is None:
+            return None
+        if not buckets:
+            return f'No probes of {host}:{port} in this range'
+
+        probes = sum(bucket[1] for bucket in buckets)
+        opened = sum(bucket[2] for bucket in buckets)
+        lines = [f'{host}:{port}: {probes} probes, ' +
+                 f'{100 * (probes - opened) / probes:.1f}% loss']
+        if opened:
+            rtt_min = min(bucket[3] for bucket in buckets if bucket[2])
+            rtt_max = max(bucket[4] for bucket in buckets)
+            rtt_avg = sum(bucket[5] for bucket in buckets) / opened
+            lines[0] += ', min/avg/max ' + '/'.join(
+                tcping.format_time(rtt) for rtt in [rtt_min, rtt_avg, rtt_max])
+
+        for start, probes, opened, _, rtt_max, rtt_sum in buckets:
+            line = time.strftime('%m-%d %H:%M', time.localtime(start)) + \
+                f'  loss {100 * (probes - opened) / probes:5.1f}%'
+            if opened:
+                line += f'  avg {tcping.format_time(rtt_sum / opened)}' + \
+                    f'  max {tcping.format_time(rtt_max)}'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def close(self) -> None:
+        with self.lock:
+            for ring in self.rings.values():
+                ring.close()
+            self.rings.clear()
+
+
+class ProgressWriter(tcping.TableWriter):
+    """
+    TableWriter which also calls callback() at most every interval
+    seconds while probes are written.
+    """
+
+    def __init__(self, stream, callback, interval=1) -> None:
+        super().__init__(stream)
+        self.callback = callback
+        self.interval = interval
+        self.last_progress = time.monotonic()
+        self.last_result = None
+
+    def write(self, result) -> None:
+        super().write(result)
+        self.last_result = result
+        if time.monotonic() - self.last_progress >= self.interval:
+            self.last_progress = time.monotonic()
+            self.callback()
+
+
+class SessionJob:
+    """
+    tcping session submitted to SessionPool. Probe lines and summary go
+    to log (StringIO), progress(job) is called at most every
+    progress_interval seconds while it runs and once when it is over.
+    progress may block (e.g. on bot API), so it is called on notifier
+    executor, if given, not on the probing thread. While one update is
+    queued, others are dropped: it describes the job when it runs.
+    """
+
+    def __init__(self, job_id, host, port, count, timeout, interval,
+                 progress=None, progress_interval=1, notifier=None) -> None:
+        self.id = job_id
+        self.host = host
+        self.port = port
+        self.args = (count, timeout, interval)
+        self.progress = progress or (lambda job: None)
+        self.notifier = notifier
+        self.update_queued = False
+        self.final_sent = False
+
+        self.log = io.StringIO()
+        self.writer = ProgressWriter(self.log, self.notify, progress_interval)
+        self.session = None
+        self.future = None
+        self.state = JOB_QUEUED
+        self.error = None
+        self.cancelled = False
+        self.lock = Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in [JOB_DONE, JOB_CANCELLED, JOB_FAILED]
+
+    def notify(self) -> None:
+        """
+        Queues progress update, unless one is queued already.
+        """
+        if self.notifier is None:
+            self.send_progress()
+            return
+        with self.lock:
+            if self.update_queued:
+                return
+            self.update_queued = True
+        self.notifier.submit(self.send_progress)
+
+    def send_progress(self) -> None:
+        with self.lock:
+            self.update_queued = False
+            # update queued before the job ended may already see it over
+            if self.finished:
+                if self.final_sent:
+                    return
+                self.final_sent = True
+        self.progress(self)
+
+    def cancel(self) -> bool:
+        """
+        Cancels queued job or stops running session.
+        Returns False if the job is over already.
+        """
+        with self.lock:
+            if self.finished:
+                return False
+            self.cancelled = True
+            if self.session is not None:
+                self.session.stop()
+        if self.future is not None and self.future.cancel():
+            self.state = JOB_CANCELLED
+            self.notify()
+        return True
+
+    def run(self) -> None:
+        with self.lock:
+            self.state = JOB_CANCELLED if self.cancelled else JOB_RUNNING
+        self.notify()
+        if self.state == JOB_CANCELLED:
+            return
+
+        try:
+            session = tcping.Session(self.host, self.port, *self.args,
+                                     output=self.writer)
+            with self.lock:
+                self.session = session
+                if self.cancelled:
+                    session.stop()
+            session.run()
+        except Exception as e:  # invalid args, unknown host, socket errors
+            self.error = str(e) or type(e).__name__
+            self.state = JOB_FAILED
+        else:
+            self.state = JOB_CANCELLED if self.cancelled else JOB_DONE
+        finally:
+            if not self.finished:
+                self.error = 'session exited'
+                self.state = JOB_FAILED
+            self.notify()
+
+    def describe(self) -> str:
+        """
+        Returns one-line human-readable progress of the job.
+        """
+        res = f'Job #{self.id} {self.host}:{self.port} {self.state}'
+        if self.state == JOB_FAILED:
+            return f'{res}: {self.error}'
+        if self.session is None:
+            return res
+
+        stat = self.session.stat
+        res += f': {stat.send}/{self.args[0]} probes, {stat.recv} open'
+        if self.finished:
+            if stat.count:
+                res += ', min/avg/max ' + '/'.join(
+                    tcping.format_time(t)
+                    for t in [stat.min_t, stat.get_avg_time(), stat.max_t])
+        elif self.writer.last_result is not None:
+            result = self.writer.last_result
+            res += ', last ' + (tcping.format_time(result.rtt) if result.ok
+                                else result.state)
+        return res
+
+
+class SessionPool:
+    """
+    Bounded pool of tcping sessions started by bot commands: up to
+    workers sessions run at once, up to max_jobs more wait in queue.
+    Jobs get IDs, so they can be looked up and cancelled. Progress
+    of all jobs is reported by one notifier thread.
+    """
+
+    def __init__(self, workers=4, max_jobs=16, progress_interval=1) -> None:
+        self.max_jobs = max_jobs
+        self.progress_interval = progress_interval
+        self.executor = ThreadPoolExecutor(workers)
+        self.notifier = ThreadPoolExecutor(1)
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = Lock()
+
+    def submit(self, host, port, count, timeout, interval, progress=None):
+        """
+        Queues new session, returns its SessionJob, or None if
+        there are max_jobs unfinished jobs already.
+        """
+        with self.lock:
+            if len(self.jobs) >= self.max_jobs:
+                return None
+            job = SessionJob(next(self.ids), host, port, count, timeout,
+                             interval, progress, self.progress_interval,
+                             self.notifier)
+            self.jobs[job.id] = job
+
+        job.future = self.executor.submit(job.run)
+        job.future.add_done_callback(lambda _: self.forget(job))
+        return job
+
+    def forget(self, job) -> None:
+        with self.lock:
+            self.jobs.pop(job.id, None)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def active(self) -> list:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id) -> bool:
+        job = self.get(job_id)
+        return job is not None and job.cancel()
+
+    def shutdown(self) -> None:
+        for job in self.active():
+            job.cancel()
+        self.executor.shutdown(wait=True)
+        self.notifier.shutdown(wait=True)
@@ -1,45 +1,137 @@
 import argparse
 import array
+import collections
+import csv
+import ctypes
+import errno
+import functools
+import heapq
+import io
+import itertools
+import ipaddress
+import json
+import math
+import mmap
+import os
 import random
+import selectors
 import struct
 import sys
 import socket
-from threading import current_thread
+from threading import current_thread, Condition, Event, Lock, Thread
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
 from time import sleep
-import signal
 import sys
 import platform
 import select
-from texttable import Texttable
-from scapy.all import IP, TCP, srloop, SndRcvList, sr1, sr
 
 
 LINUX_FLAG = True
 WD_MODE = False
 
+PORT_OPEN = 'open'
+PORT_CLOSED = 'closed'
+PORT_FILTERED = 'filtered'
+PORT_UNREACHABLE = 'unreachable'
+
+ICMP_DEST_UNREACH = 3
+ICMP_FILTERED_CODES = {9, 10, 13}      # Communication administratively
+                                       # prohibited (RFC 1812)
+
+MODE_RAW = 'raw'
+MODE_CONNECT = 'connect'
+MODE_SCAPY = 'scapy'
+MODES = [MODE_RAW, MODE_CONNECT, MODE_SCAPY]
+
+RCVBUF_SIZE = 4 * 1024 * 1024
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+
 if platform.system() != 'Linux':
     LINUX_FLAG = False
 
+class Histogram:
+    """
+    Fixed-size log-bucketed (HDR-style) histogram of non-negative ints.
+    Values below 2 ** sub_bits are counted exactly, bigger ones with
+    relative error under 2 ** (1 - sub_bits). Histograms with the same
+    layout can be merged.
+    """
+
+    def __init__(self, sub_bits=7, max_bits=40) -> None:
+        self.sub_bits = sub_bits
+        self.max_value = (1 << max_bits) - 1
+        self.half = 1 << (sub_bits - 1)
+        self.counts = array.array(
+            'Q', bytes(8 * self.bucket_index(self.max_value) + 8))
+        self.total = 0
+
+    def bucket_index(self, value) -> int:
+        shift = value.bit_length() - self.sub_bits
+        if shift <= 0:
+            return value
+        return shift * self.half + (value >> shift)
+
+    def bucket_value(self, index) -> int:
+        """
+        Returns middle of values counted in bucket.
+        """
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half) << shift) + (1 << (shift - 1))
+
+    def add(self, value) -> None:
+        value = min(max(int(value), 0), self.max_value)
+        self.counts[self.bucket_index(value)] += 1
+        self.total += 1
+
+    def merge(self, other) -> None:
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+
+    def percentile(self, percent) -> int:
+        if self.total == 0:
+            return -1
+
+        rank = max(1, math.ceil(self.total * percent / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bucket_value(index)
+        return self.max_value
+
+
 class Stat:
     """
     Use this class as a container for tcping statistics.
+    RTT values are kept in microseconds. All accumulators are updated
+    in O(1) and take constant memory, no matter how long the session is.
     """
 
     def __init__(self) -> None:
-        self.time_deltas = []
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
 
-        self.min_t = 0
-        self.max_t = 0
-        self.avg_t = 0
+        self.min_t = -1
+        self.max_t = -1
+        self.hist = Histogram()
 
         self.send = 0
         self.recv = 0
 
+        self.rejected = 0
+
     def get_avg_time(self) -> int:
-        if self.recv == 0:
+        if self.count == 0:
             return -1
-        return round(sum(self.time_deltas) / self.recv)
+        return round(self.mean)
 
     def get_packet_loss(self) -> str:
         if self.send != 0:
@@ -47,69 +139,843 @@ class Stat:
         return 0
 
     def add_delta(self, delta) -> None:
-        self.time_deltas.append(delta)
+        self.count += 1
+        diff = delta - self.mean
+        self.mean += diff / self.count
+        self.m2 += diff * (delta - self.mean)
+
+        if self.count == 1 or delta < self.min_t:
+            self.min_t = delta
+        if self.count == 1 or delta > self.max_t:
+            self.max_t = delta
+
+        self.hist.add(delta)
 
     def max_delta(self) -> None:
-        if len(self.time_deltas) != 0:
-            return max(self.time_deltas)
-        return -1
+        return self.max_t
 
     def min_delta(self) -> None:
-        if len(self.time_deltas) != 0:
-            return min(self.time_deltas)
-        return -1
+        return self.min_t
 
-    def print(self) -> None:
-        print("\n")
+    def get_jitter(self) -> int:
+        """
+        Returns standard deviation of RTT.
+        """
+        if self.count == 0:
+            return -1
+        return round(math.sqrt(self.m2 / self.count))
+
+    def get_percentile(self, percent) -> int:
+        res = self.hist.percentile(percent)
+        if res == -1:
+            return res
+        return min(max(res, self.min_t), self.max_t)
+
+    def merge(self, other) -> None:
+        """
+        Adds statistics of other session to this one.
+        """
+        self.send += other.send
+        self.recv += other.recv
+        self.rejected += other.rejected
+
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.min_t, self.max_t = other.min_t, other.max_t
+        else:
+            self.min_t = min(self.min_t, other.min_t)
+            self.max_t = max(self.max_t, other.max_t)
+
+        count = self.count + other.count
+        diff = other.mean - self.mean
+        self.m2 += other.m2 + diff * diff * self.count * other.count / count
+        self.mean += diff * other.count / count
+        self.count = count
+
+        self.hist.merge(other.hist)
+
+    def as_dict(self) -> dict:
+        return {
+            'sent': self.send,
+            'received': self.recv,
+            'loss_percent': self.get_packet_loss(),
+            'avg_us': self.get_avg_time(),
+            'min_us': self.min_delta(),
+            'max_us': self.max_delta(),
+            'p50_us': self.get_percentile(50),
+            'p90_us': self.get_percentile(90),
+            'p99_us': self.get_percentile(99),
+            'jitter_us': self.get_jitter(),
+            'rejected': self.rejected,
+        }
+
+    def draw(self) -> str:
+        from texttable import Texttable
         table = Texttable(max_width=150)
-        fst_row = ['Avg', 'Min', 'Max', 'Sent', 'Recieved', 'Packet loss']
+        fst_row = ['Avg', 'Min', 'Max', 'P50', 'P90', 'P99', 'Jitter',
+                   'Sent', 'Recieved', 'Packet loss']
 
-        left_part = list(map(lambda x: str(x) + 'ms', [self.get_avg_time(),
-                         self.min_delta(), self.max_delta()]))
+        left_part = list(map(format_time, [
+            self.get_avg_time(), self.min_delta(), self.max_delta(),
+            self.get_percentile(50), self.get_percentile(90),
+            self.get_percentile(99), self.get_jitter()]))
         right_part = [self.send, self.recv, str(self.get_packet_loss()) + '%']
         sec_row = left_part + right_part
 
         table.add_rows([fst_row, sec_row])
-        print(table.draw())
+        return table.draw()
 
+    def print(self) -> None:
+        print("\n")
+        print(self.draw())
 
-stat = Stat()
 
+class HostStates:
+    """
+    Thread-safe in-memory store of target states for WatchDog.
+    Targets are (host, port) pairs, so ports of the same host are
+    tracked separately. Probe daemons publish states, and every
+    transition wakes up the watcher immediately instead of it polling
+    for changes.
+    """
 
-def sigint_handler(signal, frame):
-    stat.print()
-    sys.exit(0)
+    def __init__(self) -> None:
+        self.states = {}
+        self.transitions = collections.deque()
+        self.cond = Condition()
+
+    def publish(self, target, online) -> None:
+        with self.cond:
+            prev = self.states.get(target)
+            if prev == online:
+                return
+            self.states[target] = online
+            self.transitions.append((target, prev, online))
+            self.cond.notify_all()
+
+    def get(self, target):
+        with self.cond:
+            return self.states.get(target)
+
+    def clear(self) -> None:
+        with self.cond:
+            self.states.clear()
+            self.transitions.clear()
+
+    def wait_transitions(self, timeout=None) -> list:
+        """
+        Blocks until some target changes its state (or timeout passes),
+        returns list of ((host, port), prev_state, cur_state)
+        transitions. prev_state is None for the first state of a target.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.transitions, timeout)
+            transitions = list(self.transitions)
+            self.transitions.clear()
+        return transitions
+
+
+class Pacer:
+    """
+    Process-wide token bucket shared by all sessions, engines and
+    sweeps. Tokens are reserved ahead, so senders which have to wait
+    are spread evenly at 1 / pps apart. pps = 0 means no limit.
+    """
 
+    def __init__(self, pps=0, burst=1, jitter=0) -> None:
+        self.lock = Lock()
+        self.configure(pps, burst, jitter)
+
+        self.acquired = 0
+        self.delayed = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def configure(self, pps, burst=1, jitter=0) -> None:
+        """
+        jitter is a fraction of 1 / pps randomly added to every wait.
+        """
+        with self.lock:
+            self.pps = pps
+            self.burst = max(burst, 1)
+            self.jitter = jitter
+            self.tokens = self.burst
+            self.last = time.monotonic()
+
+    def reserve(self) -> float:
+        """
+        Takes a token and returns how many seconds caller has to wait
+        before sending.
+        """
+        with self.lock:
+            self.acquired += 1
+            if self.pps <= 0:
+                return 0
+
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.pps)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+
+            delay = -self.tokens / self.pps
+            if self.jitter:
+                delay += random.uniform(0, self.jitter / self.pps)
+
+            self.delayed += 1
+            self.wait_time += delay
+            self.max_wait = max(self.max_wait, delay)
+        return delay
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            sleep(delay)
 
-def is_positive_num(arg):
+    def print(self) -> None:
+        print(f'Pacer: {self.delayed} of {self.acquired} probes waited ' +
+              f'for a token, total wait {self.wait_time:.3f}s, ' +
+              f'max wait {self.max_wait * 1000:.3f}ms')
+
+
+class StageStats:
+    """
+    Opt-in counters and sampled timers (ns) for hot path stages:
+    building packets, sendto, poll, recv and parsing of replies, plus
+    poll wakeups, matched / unmatched replies and timeouts.
+    Counters count every event, while stages are timed for about one
+    of every sample_every iterations of hot loops, chosen at random,
+    and totals are estimated by scaling. Timing costs microseconds per
+    iteration, sampling keeps it under 1% of a probe.
+    Hot loops draw timed = enabled and random() < rate once per
+    iteration, count events in local ints and add them by add_counts(),
+    so enabled stats cost tens of nanoseconds per probe.
+    """
+
+    stages = ['build', 'send', 'poll', 'recv', 'parse']
+    counter_names = ['wakeups', 'matched', 'unmatched', 'timeouts',
+                     'send_errors']
+
+    def __init__(self, enabled=True, sample_every=256) -> None:
+        self.enabled = enabled
+        self.sample_every = sample_every
+        self.rate = 1 / sample_every
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        self.calls = dict.fromkeys(self.stages, 0)
+        self.time_ns = dict.fromkeys(self.stages, 0)
+        self.counters = dict.fromkeys(self.counter_names, 0)
+
+    def start(self) -> int:
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def lap(self, stage, start) -> int:
+        """
+        Adds time since start to stage and returns current time,
+        which can be the start of the next stage.
+        """
+        if not self.enabled:
+            return 0
+        now = time.perf_counter_ns()
+        self.calls[stage] += 1
+        self.time_ns[stage] += now - start
+        return now
+
+    def inc(self, counter, n=1) -> None:
+        if self.enabled:
+            self.counters[counter] += n
+
+    def add_counts(self, *counts) -> None:
+        """
+        Adds counts of events, given in counter_names order.
+        """
+        if self.enabled:
+            for name, n in zip(self.counter_names, counts):
+                self.counters[name] += n
+
+    def estimated_ns(self, stage) -> int:
+        """
+        Estimated total time of stage, sampled time scaled up.
+        """
+        return self.time_ns[stage] * self.sample_every
+
+    def __getstate__(self) -> dict:
+        # lock can't be pickled, worker processes send stats without it
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state) -> None:
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def merge(self, other) -> None:
+        with self.lock:
+            for stage in self.stages:
+                self.calls[stage] += other.calls[stage]
+                self.time_ns[stage] += other.time_ns[stage]
+            for name in self.counter_names:
+                self.counters[name] += other.counters[name]
+
+    def as_dict(self) -> dict:
+        res = {name: {'calls': self.calls[name], 'ns': self.time_ns[name],
+                      'estimated_ns': self.estimated_ns(name)}
+               for name in self.stages}
+        res.update(self.counters)
+        res['sample_every'] = self.sample_every
+        return res
+
+    def draw(self) -> str:
+        from texttable import Texttable
+        table = Texttable(max_width=150)
+        rows = [['Stage', 'Sampled', 'Est. total', 'Avg']]
+        for name in self.stages:
+            calls, total = self.calls[name], self.estimated_ns(name)
+            avg = self.time_ns[name] // calls if calls else 0
+            rows.append([name, calls, f'{total / 1e6:.3f}ms', f'{avg}ns'])
+        table.add_rows(rows)
+
+        counters = ', '.join(f'{name} = {self.counters[name]}'
+                             for name in self.counter_names)
+        return table.draw() + \
+            f'\nTimed 1 of {self.sample_every} iterations, ' + counters
+
+    def print(self, file=None) -> None:
+        print(self.draw(), file=file or sys.stderr)
+
+
+NO_STAGES = StageStats(enabled=False)
+
+
+class ProbeResult:
+    """
+    Result of single probe, rtt is in microseconds or None on timeout.
+    state is PORT_OPEN (SYN-ACK), PORT_CLOSED (RST), PORT_FILTERED
+    (timeout or ICMP prohibited) or PORT_UNREACHABLE (other ICMP
+    destination unreachable). rtt is kept for every answered probe,
+    but only open ones count as received.
+    """
+
+    fields = ['time', 'host', 'dst_ip', 'port', 'seq', 'state', 'rtt_us']
+
+    def __init__(self, host, dst_ip, port, seq_num, rtt, state=None,
+                 timestamp=None) -> None:
+        self.host = host
+        self.dst_ip = dst_ip
+        self.port = port
+        self.seq_num = seq_num
+        self.rtt = rtt
+
+        if state is None:
+            state = PORT_FILTERED if rtt is None else PORT_OPEN
+        self.state = state
+        self.time = time.time() if timestamp is None else timestamp
+
+    @property
+    def ok(self) -> bool:
+        return self.state == PORT_OPEN
+
+    def as_dict(self) -> dict:
+        return {
+            'time': round(self.time, 6),
+            'host': self.host,
+            'dst_ip': self.dst_ip,
+            'port': self.port,
+            'seq': self.seq_num,
+            'state': self.state,
+            'rtt_us': self.rtt,
+        }
+
+    def __repr__(self) -> str:
+        return (f'ProbeResult({self.host!r}, {self.dst_ip!r}, {self.port}, '
+                f'{self.seq_num}, {self.rtt}, {self.state!r})')
+
+
+class RecordWriter:
+    """
+    Base class for result writers. Formatted records are buffered
+    and written to stream in batches (or after flush_interval seconds),
+    instead of one write per probe.
+    """
+
+    def __init__(self, stream=None, batch=64, flush_interval=1) -> None:
+        self.stream = sys.stdout if stream is None else stream
+        self.batch = batch
+        self.flush_interval = flush_interval
+
+        self.lines = []
+        self.last_flush = time.monotonic()
+        self.lock = Lock()
+
+    def format(self, result) -> str:
+        raise NotImplementedError
+
+    def format_summary(self, stat) -> str:
+        return ''
+
+    def emit(self, line) -> None:
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= self.batch or \
+                    time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush_lines()
+
+    def flush_lines(self) -> None:
+        if self.lines:
+            self.stream.write(''.join(self.lines))
+            self.lines.clear()
+        self.stream.flush()
+        self.last_flush = time.monotonic()
+
+    def write(self, result) -> None:
+        self.emit(self.format(result))
+
+    def summary(self, stat) -> None:
+        self.emit(self.format_summary(stat))
+        self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            self.flush_lines()
+
+
+class TableWriter(RecordWriter):
+    """
+    Human-readable output: one line per probe and Texttable summary.
+    """
+
+    def __init__(self, stream=None, batch=1, flush_interval=1,
+                 sweep=False) -> None:
+        super().__init__(stream, batch, flush_interval)
+        self.sweep = sweep
+        self.states = {PORT_OPEN: 0, PORT_CLOSED: 0, PORT_FILTERED: 0,
+                       PORT_UNREACHABLE: 0}
+
+    def format(self, result) -> str:
+        self.states[result.state] += 1
+        target = f'{result.dst_ip}:[{result.port}]'
+
+        if self.sweep:
+            if result.ok:
+                return f'{target} is open, time = {format_time(result.rtt)}\n'
+            return f'{target} is {result.state}\n'
+
+        if result.ok:
+            return (f'OK! Got response from {target}' +
+                    f' : seq = {result.seq_num}, ' +
+                    f'time = {format_time(result.rtt)}\n')
+        if result.state == PORT_CLOSED:
+            return f'Port is closed on target host: {target}\n'
+        if result.state == PORT_UNREACHABLE:
+            return f'Target host is unreachable: {target}\n'
+        return f'Unable to get a response from target host: {target}\n'
+
+    def format_summary(self, stat) -> str:
+        res = '\n\n' + stat.draw() + '\n'
+        if self.sweep:
+            res += (f'Open: {self.states[PORT_OPEN]}, ' +
+                    f'closed: {self.states[PORT_CLOSED]}, ' +
+                    f'filtered: {self.states[PORT_FILTERED]}, ' +
+                    f'unreachable: {self.states[PORT_UNREACHABLE]}\n')
+        return res
+
+
+class JsonLinesWriter(RecordWriter):
+    """
+    One JSON object per line, summary is the last line.
+    """
+
+    def format(self, result) -> str:
+        return json.dumps(dict(type='probe', **result.as_dict())) + '\n'
+
+    def format_summary(self, stat) -> str:
+        return json.dumps(dict(type='summary', **stat.as_dict())) + '\n'
+
+
+class CsvWriter(RecordWriter):
+    """
+    CSV with header, one row per probe.
+    """
+
+    def __init__(self, stream=None, batch=64, flush_interval=1) -> None:
+        super().__init__(stream, batch, flush_interval)
+        self.buf = io.StringIO()
+        self.csv = csv.DictWriter(self.buf, ProbeResult.fields)
+        self.csv.writeheader()
+        self.emit(self.take())
+
+    def take(self) -> str:
+        line = self.buf.getvalue()
+        self.buf.seek(0)
+        self.buf.truncate()
+        return line
+
+    def format(self, result) -> str:
+        self.csv.writerow(result.as_dict())
+        return self.take()
+
+
+class MemoryWriter(RecordWriter):
+    """
+    Keeps ProbeResult objects and summary in memory, nothing is written.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(io.StringIO())
+        self.results = []
+        self.stat = None
+
+    def write(self, result) -> None:
+        self.results.append(result)
+
+    def summary(self, stat) -> None:
+        self.stat = stat
+
+
+WRITERS = {
+    'table': TableWriter,
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+}
+
+
+wd_states = HostStates()
+pacer = Pacer()
+
+
+def check_positive(arg):
+    """
+    Raises ValueError if arg is not a positive number.
+    """
     if not ((type(arg) is int or type(arg) == float) and arg > 0):
-        print('You can only use positive numbers ' +
-              'for port, count, interval and timeout')
+        raise ValueError('You can only use positive numbers ' +
+                         'for port, count, interval, timeout and window')
+
+
+def check_port(port):
+    """
+    Raises ValueError if port is out of 1-65535 range.
+    """
+    if not (port >= 1 and port <= 65535):
+        raise ValueError('Port number must be in range from 1 to 65535')
+
+
+def check_probe_args(port, count, timeout, interval, window=1):
+    """
+    Raises ValueError for invalid probing arguments, counterpart of
+    is_positive_num() and validate_port() for library callers.
+    """
+    for arg in [port, count, timeout, interval, window]:
+        check_positive(arg)
+    check_port(port)
+
+
+def is_positive_num(arg):
+    try:
+        check_positive(arg)
+    except ValueError as e:
+        print(e)
         sys.exit(2)
 
 
 def validate_port(port):
-    if not (port >= 1 and port < 65535):
-        print('Port number must be in range from 1 to 65635')
+    try:
+        check_port(port)
+    except ValueError as e:
+        print(e)
         sys.exit(3)
 
 
-def new_socket(timeout):
+def default_mode():
+    """
+    Raw sockets (Linux) and scapy (other systems) need root,
+    without it handshakes are timed with plain connect().
+    """
+    if getattr(os, 'geteuid', lambda: 0)() != 0:
+        return MODE_CONNECT
+    return MODE_RAW if LINUX_FLAG else MODE_SCAPY
+
+
+def set_rcvbuf(soc, size=RCVBUF_SIZE):
+    """
+    Raw socket gets a copy of every TCP segment on the host,
+    so default receive buffer overflows quickly on bursts.
+    """
+    try:
+        soc.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+    except socket.error:
+        soc.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+
+def open_raw_socket(timeout, family=socket.AF_INET):
     """
     Creates new raw socket with injectable TCP layer,
     so we can create the TCP packet in our own.
+    IPv6 raw socket gets TCP segments without IP header.
+    Raises OSError (PermissionError without root).
     """
+    soc = socket.socket(family, socket.SOCK_RAW, socket.IPPROTO_TCP)
+    try:
+        soc.settimeout(timeout)
+        set_rcvbuf(soc)
+    except socket.error:
+        soc.close()
+        raise
+    return soc
+
 
+def new_socket(timeout, family=socket.AF_INET):
+    """
+    open_raw_socket() for command line paths: exits with code 4
+    if raw socket can't be created.
+    """
+    try:
+        return open_raw_socket(timeout, family)
+    except socket.error as err:
+        print('Unable to create raw socket due to error: ', err)
+        sys.exit(4)
+
+
+def new_icmp_socket():
+    """
+    Creates non-blocking raw ICMP socket for destination unreachable
+    messages about our probes, or returns None if it is not permitted.
+    """
     try:
         soc = socket.socket(
             socket.AF_INET,
             socket.SOCK_RAW,
-            socket.IPPROTO_TCP)
-        soc.settimeout(timeout)
+            socket.IPPROTO_ICMP)
+        soc.setblocking(False)
+    except socket.error:
+        return None
+    return soc
+
+
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)
+
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_IND = 0x48
+BPF_LD_B_IND = 0x50
+BPF_LDX_B_MSH = 0xb1
+BPF_ALU_AND_K = 0x54
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_RET_K = 0x06
+
+
+def build_bpf_filter(src_port, dst_ip=None):
+    """
+    Returns classic BPF program (list of (code, jt, jf, k)) which accepts
+    only SYN-ACK and RST segments sent to src_port (and from dst_ip,
+    if it is given). Everything else is dropped by kernel.
+    """
+    program = []
+    if dst_ip is not None:
+        ip = struct.unpack('!I', socket.inet_aton(dst_ip))[0]
+        program += [
+            (BPF_LD_W_ABS, 0, 0, 12),           # A = ip.src
+            (BPF_JEQ_K, 0, 8, ip),              # != dst_ip -> drop
+        ]
+
+    program += [
+        (BPF_LDX_B_MSH, 0, 0, 0),               # X = ip.ihl * 4
+        (BPF_LD_H_IND, 0, 0, 2),                # A = tcp.dport
+        (BPF_JEQ_K, 0, 5, src_port),            # != src_port -> drop
+        (BPF_LD_B_IND, 0, 0, 13),               # A = tcp.flags
+        (BPF_JSET_K, 2, 0, 0x04),               # RST -> accept
+        (BPF_ALU_AND_K, 0, 0, 0x12),
+        (BPF_JEQ_K, 0, 1, 0x12),                # !SYN-ACK -> drop
+        (BPF_RET_K, 0, 0, 0xffff),              # accept
+        (BPF_RET_K, 0, 0, 0),                   # drop
+    ]
+    return program
+
+
+def attach_bpf_filter(soc, src_port, dst_ip=None):
+    """
+    Attaches BPF filter to raw socket with SO_ATTACH_FILTER, so only
+    our replies are copied to userspace and wake the process.
+    """
+    set_bpf_program(soc, build_bpf_filter(src_port, dst_ip))
+
+
+def set_bpf_program(soc, program):
+    insns = ctypes.create_string_buffer(
+        b''.join(struct.pack('HBBI', *insn) for insn in program))
+    fprog = struct.pack('HL', len(program), ctypes.addressof(insns))
+
+    try:
+        soc.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
     except socket.error as err:
-        print('Unable to create raw socket due to error: ', err)
+        print('Unable to attach BPF filter due to error: ', err)
         sys.exit(4)
-    return soc
+
+
+SOL_PACKET = getattr(socket, 'SOL_PACKET', 263)
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+PACKET_OUTGOING = 4
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+ETH_P_IP = 0x0800
+
+TPACKET_REQ3 = struct.Struct('IIIIIII')
+BLOCK_HDR = struct.Struct('III')        # block_status, num_pkts,
+                                        # offset_to_first_pkt
+PACKET_HDR = struct.Struct('IIIIIIHH')  # tp_next_offset, tp_sec, tp_nsec,
+                                        # tp_snaplen, tp_len, tp_status,
+                                        # tp_mac, tp_net
+BLOCK_STATUS = struct.Struct('I')
+BLOCK_HDR_OFFSET = 8                    # after version, offset_to_priv
+PKTTYPE_OFFSET = 48 + 10                # sockaddr_ll.sll_pkttype after
+                                        # aligned tpacket3_hdr
+
+
+class PacketRing:
+    """
+    Receive backend reading IPv4 packets from AF_PACKET memory-mapped
+    ring (PACKET_RX_RING, TPACKET_V3). Kernel fills whole blocks of
+    packets, which are parsed in place through memoryview, without
+    a syscall or a copy per packet. Only replies to src_port pass
+    its BPF filter. Timestamps are CLOCK_REALTIME, like SO_TIMESTAMPNS.
+    """
+
+    def __init__(self, src_port, block_size=1 << 18, block_nr=16,
+                 frame_size=2048, retire_ms=5) -> None:
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.block = 0
+
+        try:
+            self.soc = socket.socket(
+                socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
+            attach_bpf_filter(self.soc, src_port)
+            self.soc.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            self.soc.setsockopt(SOL_PACKET, PACKET_RX_RING, TPACKET_REQ3.pack(
+                block_size, block_nr, frame_size,
+                block_size * block_nr // frame_size, retire_ms, 0, 0))
+            self.ring = mmap.mmap(self.soc.fileno(), block_size * block_nr)
+        except (socket.error, AttributeError) as err:
+            print('Unable to create packet ring due to error: ', err)
+            sys.exit(4)
+        self.view = memoryview(self.ring)
+
+    def fileno(self) -> int:
+        return self.soc.fileno()
+
+    def packets(self):
+        """
+        Yields (packet, receive time in ns, None) for every packet of
+        blocks kernel handed over, each block is given back once it is
+        read. Packet is memoryview into the ring, so it must be parsed
+        before asking for the next one. Source IP is in its IPv4 header,
+        like for recv_reply().
+        """
+        view = self.view
+        while True:
+            block = self.block * self.block_size
+            status, num_pkts, offset = BLOCK_HDR.unpack_from(
+                view, block + BLOCK_HDR_OFFSET)
+            if not status & TP_STATUS_USER:
+                return
+
+            offset += block
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, snaplen, _, _, mac, net = \
+                    PACKET_HDR.unpack_from(view, offset)
+                if view[offset + PKTTYPE_OFFSET] != PACKET_OUTGOING:
+                    start = offset + net
+                    yield (view[start:start + snaplen - (net - mac)],
+                           sec * 1000000000 + nsec, None)
+                offset += next_offset
+
+            BLOCK_STATUS.pack_into(
+                view, block + BLOCK_HDR_OFFSET, TP_STATUS_KERNEL)
+            self.block = (self.block + 1) % self.block_nr
+
+    def close(self) -> None:
+        self.view.release()
+        try:
+            self.ring.close()
+        except BufferError:
+            pass
+        self.soc.close()
+
+
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+TIMESPEC = struct.Struct('ll')
+
+
+def enable_timestamps(soc):
+    """
+    Asks kernel to stamp every received packet (SO_TIMESTAMPNS),
+    so RTT doesn't include our own scheduling delay.
+    """
+    try:
+        soc.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except socket.error as err:
+        print('Unable to enable kernel timestamps due to error: ', err)
+        sys.exit(4)
+
+
+def get_clock(timestamps):
+    """
+    Returns ns clock to stamp sent probes with. Kernel timestamps
+    are CLOCK_REALTIME, so they have to be compared with time_ns.
+    """
+    if timestamps:
+        return time.time_ns
+    return time.monotonic_ns
+
+
+TIMESTAMP_CMSG_SPACE = socket.CMSG_SPACE(TIMESPEC.size)
+
+
+def recv_reply(soc, timestamps, buf=None, is_v6=False):
+    """
+    Receives single packet, returns (packet, receive time in ns,
+    source IP). Source IP is only returned if is_v6, as IPv6 raw
+    sockets deliver TCP segment without IP header, and is None for
+    IPv4. Caller tells the family, soc.family is too slow per packet.
+    Packet is received with recv_into / recvmsg_into into buf
+    (memoryview of preallocated bytearray, reused by the caller for
+    every packet) and returned as slice of it, valid until the next call.
+    """
+    if buf is None:
+        buf = memoryview(bytearray(2048))
+
+    if not timestamps:
+        if is_v6:
+            nbytes, address = soc.recvfrom_into(buf)
+            return buf[:nbytes], time.monotonic_ns(), address[0]
+        nbytes = soc.recv_into(buf)
+        return buf[:nbytes], time.monotonic_ns(), None
+
+    nbytes, ancdata, _, address = soc.recvmsg_into(
+        [buf], TIMESTAMP_CMSG_SPACE)
+    data = buf[:nbytes]
+    src_ip = address[0] if is_v6 else None
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+            sec, nsec = TIMESPEC.unpack_from(cdata)
+            return data, sec * 1000000000 + nsec, src_ip
+    return data, time.time_ns(), src_ip
+
+
+def format_time(delta):
+    """
+    Formats RTT given in microseconds.
+    """
+    if delta == -1:
+        return '-1ms'
+    return f'{delta / 1000:.3f}ms'
 
 
 def get_response(
@@ -119,54 +985,216 @@ def get_response(
         port,
         seq_num,
         stat,
-        WD_MODE,
-        poll):
+        poll,
+        timestamps=False,
+        stages=None,
+        icmp=None,
+        buf=None,
+        src_port=None):
     """
-    Tries to get a SYN-ACK response to our SYN packet.
+    Tries to get a response to our SYN packet: SYN-ACK, RST or ICMP
+    destination unreachable (read from icmp socket, if it is given
+    and registered in poll). ICMP messages quoting SYNs not sent from
+    src_port (if given) are skipped. Waits for socket timeout in total,
+    however many unrelated packets come meanwhile. Returns (RTT in
+    microseconds, state), or (None, PORT_FILTERED) if there was no
+    response.
+    Events are counted and stages are sampled into stages (StageStats)
+    if given. Replies are received into buf, if it is given (see
+    recv_reply).
     """
-
-    init_time = time.time()
-
-    soc.sendto(syn_packet, (dst_ip, port))
-    if not WD_MODE:
-        stat.send += 1
+    stages = stages or NO_STAGES
+    counted = stages.enabled
+    counters = stages.counters
+    timed = counted and random.random() < stages.rate
+    if buf is None:
+        buf = memoryview(bytearray(2048))
+
+    is_v6 = soc.family == socket.AF_INET6
+    init_time = get_clock(timestamps)()
+    deadline = time.monotonic() + soc.gettimeout()
+
+    if timed:
+        start = stages.start()
+    soc.sendto(syn_packet, raw_address(dst_ip, port))
+    if timed:
+        start = stages.lap('send', start)
 
     while True:
-        listFdAndEvent = poll.poll(soc.gettimeout() * 1000)
+        remaining = deadline - time.monotonic()
+        listFdAndEvent = poll.poll(remaining * 1000) if remaining > 0 \
+            else []
+        if timed:
+            start = stages.lap('poll', start)
         if not listFdAndEvent:
-            if WD_MODE:
-                with open(f'{dst_ip}.txt', 'w') as fh:
-                    fh.write('0')
-                return
-            print('Unable to get a response from ' +
-                  f'target host: {dst_ip}:[{port}]')
-            return
-
-        got_fd = listFdAndEvent[0][0]
+            if counted:
+                counters['timeouts'] += 1
+            return None, PORT_FILTERED
+
+        if counted:
+            counters['wakeups'] += 1
+        for got_fd, _ in listFdAndEvent:
+            if got_fd == soc.fileno():
+                data, recv_time, src_ip = recv_reply(
+                    soc, timestamps, buf, is_v6)
+                if timed:
+                    start = stages.lap('recv', start)
+                reply_key, state = parse_reply(data, src_ip)
+
+            elif icmp is not None and got_fd == icmp.fileno():
+                try:
+                    data, recv_time, _ = recv_reply(icmp, timestamps, buf)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                if timed:
+                    start = stages.lap('recv', start)
+                reply_key, state = parse_icmp_reply(data, src_port)
+                if reply_key is None:
+                    continue
+            else:
+                continue
 
-        if got_fd == soc.fileno():
-            data = soc.recv(2048)
+            if timed:
+                start = stages.lap('parse', start)
+            if state is not None and reply_key == (port, dst_ip, seq_num + 1):
+                if counted:
+                    counters['matched'] += 1
+                return (recv_time - init_time) // 1000, state
 
-            res = struct.unpack('!BBBBIIBB', data[20:34])
+            stat.rejected += 1
+            if counted:
+                counters['unmatched'] += 1
 
-            ack_num = res[5]
-            ack_flag = res[7] == 18
 
-            if seq_num + 1 == ack_num and ack_flag:
-                delta = round((time.time() - init_time) * 1000)
+def lookup_host(host):
+    """
+    Default lookup for ResolverCache. System resolver doesn't tell
+    record TTL, so None is returned and cache uses its own TTL.
+    IPv4 address is preferred, IPv6 one is used for v6-only hosts.
+    """
+    try:
+        return socket.gethostbyname(host), None
+    except socket.gaierror:
+        infos = socket.getaddrinfo(
+            host, None, socket.AF_INET6, socket.SOCK_STREAM)
+        return infos[0][4][0], None
 
-                if WD_MODE:
-                    with open(f'{dst_ip}.txt', 'w') as fh:
-                        fh.write("1")
-                    return
 
-                print(
-                    f'OK! Got response from {dst_ip}:[{port}]' +
-                    f' : seq = {seq_num}, time = {delta}ms')
+class ResolverCache:
+    """
+    Caches host -> IP resolutions for CLI, bot and WatchDog.
+    Hits are served from dict in O(1). Entries close to expiry are
+    refreshed in background (stale address is served meanwhile),
+    failures are cached for negative_ttl seconds, and concurrent
+    lookups of one host share a single request.
+    """
 
-                stat.recv += 1
-                stat.add_delta(delta)
-                return
+    def __init__(self, ttl=60, negative_ttl=5, workers=8,
+                 lookup=lookup_host) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = 0.2
+        self.lookup = lookup
+
+        self.entries = {}
+        self.in_flight = {}
+        self.lock = Lock()
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers)
+
+    def resolve(self, host, block=True):
+        """
+        Returns IP address of host. Raises socket.gaierror if host
+        can't be resolved. With block=False returns None instead of
+        waiting for host which isn't in cache yet.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is None:
+                future = self.submit(host)
+            else:
+                ip, error, refresh_at, expires = entry
+                if now >= refresh_at:
+                    self.submit(host)
+                if now < expires or ip is not None:
+                    if ip is None:
+                        raise error
+                    return ip
+                future = self.submit(host)
+
+        if not block:
+            return None
+        return future.result()
+
+    async def resolve_async(self, host):
+        """
+        Same as resolve, but waits for lookup without blocking loop.
+        """
+        ip = self.resolve(host, block=False)
+        if ip is None:
+            with self.lock:
+                future = self.submit(host)
+            import asyncio
+            ip = await asyncio.wrap_future(future)
+        return ip
+
+    def submit(self, host):
+        future = self.in_flight.get(host)
+        if future is None:
+            future = self.pool.submit(self.refresh, host)
+            self.in_flight[host] = future
+        return future
+
+    def refresh(self, host):
+        """
+        Looks host up and caches the result. Any lookup failure
+        (e.g. UnicodeError of invalid name) is cached and raised
+        as socket.gaierror.
+        """
+        try:
+            ip, ttl = self.lookup(host)
+        except Exception as e:
+            err = e if isinstance(e, socket.gaierror) else \
+                socket.gaierror(socket.EAI_NONAME, f'{host}: {e}')
+            now = time.monotonic()
+            expires = now + self.negative_ttl
+            with self.lock:
+                old = self.entries.get(host)
+                if old is not None and old[0] is not None:
+                    self.entries[host] = (old[0], None, expires, expires)
+                    return old[0]
+                self.entries[host] = (None, err, expires, expires)
+            raise err
+        else:
+            if ttl is None:
+                ttl = self.ttl
+            now = time.monotonic()
+            with self.lock:
+                self.entries[host] = (
+                    ip, None, now + ttl * (1 - self.refresh_ahead), now + ttl)
+            return ip
+        finally:
+            # entry is stored before, so no lookup is duplicated
+            with self.lock:
+                self.in_flight.pop(host, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def after_fork(self) -> None:
+        """
+        Makes new lock and pool in forked process: it inherits state
+        of parent's pool, but not its threads, so lookups submitted
+        to it would never run.
+        """
+        self.lock = Lock()
+        self.in_flight = {}
+        self.pool = ThreadPoolExecutor(self.workers)
+
+
+resolver = ResolverCache()
 
 
 def get_dst_ip(host):
@@ -174,30 +1202,63 @@ def get_dst_ip(host):
     Returns IP address for domain name with validation.
     """
     try:
-        host_ip = socket.gethostbyname(host)
+        host_ip = resolver.resolve(host)
     except socket.error:
         print('Can\'t get IP address for this domain name')
         sys.exit(5)
     return host_ip
 
 
-def get_src_ip():
+def ip_family(ip):
+    return socket.AF_INET6 if ':' in ip else socket.AF_INET
+
+
+def raw_address(dst_ip, port):
+    """
+    Returns sendto() address for raw socket: IPv6 raw socket only
+    accepts 0 (or its protocol) as port, IPv4 one ignores it.
+    """
+    return (dst_ip, 0) if ip_family(dst_ip) == socket.AF_INET6 \
+        else (dst_ip, port)
+
+
+def resolve_all(host):
     """
-    Allows to get an actual src_ip.
+    Returns every distinct address (IPv6 and IPv4) of host
+    in getaddrinfo order.
     """
-    soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    soc.connect(('1.1.1.1', 53))
+    try:
+        infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        print('Can\'t get IP address for this domain name')
+        sys.exit(5)
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
+
+def get_src_ip(dst_ip='1.1.1.1'):
+    """
+    Allows to get an actual src_ip (the one kernel will use
+    to reach dst_ip).
+    """
+    soc = socket.socket(ip_family(dst_ip), socket.SOCK_DGRAM)
+    soc.connect((dst_ip, 53))
 
     src_ip = soc.getsockname()[0]
     soc.close()
     return src_ip
 
 
-def get_avail_port(soc):
+def get_avail_port(soc, ports=None):
+    """
+    Binds socket to random free port of ports range (dynamic
+    49152-65535 by default) and returns it.
+    """
+    address = '::' if soc.family == socket.AF_INET6 else '0.0.0.0'
+    ports = ports or range(49152, 65536)
     while (True):
-        port = random.randint(49152, 65535)
+        port = random.choice(ports)
         try:
-            soc.bind(('0.0.0.0', port))
+            soc.bind((address, port))
         except socket.error:
             continue
         else:
@@ -219,7 +1280,8 @@ def get_checksum(msg):
 def form_packet(src_ip, src_port, dst_ip, dst_port, seq_num, flag):
     """
     This func is responsible for creation TCP SUN packet
-    with checksum for pseudo header.
+    with checksum for pseudo header (IPv4 or IPv6 one, depending
+    on addresses).
     """
     tcp_header = struct.pack(
         '!HHIIBBH',
@@ -237,13 +1299,22 @@ def form_packet(src_ip, src_port, dst_ip, dst_port, seq_num, flag):
         2048,           # Window Size
     )
 
-    pshdr = struct.pack(
-        '!4s4sHH',
-        socket.inet_aton(src_ip),
-        socket.inet_aton(dst_ip),
-        socket.IPPROTO_TCP,
-        len(tcp_header) + 4
-    )
+    if ip_family(dst_ip) == socket.AF_INET6:
+        pshdr = struct.pack(
+            '!16s16sI3xB',
+            socket.inet_pton(socket.AF_INET6, src_ip),
+            socket.inet_pton(socket.AF_INET6, dst_ip),
+            len(tcp_header) + 4,
+            socket.IPPROTO_TCP
+        )
+    else:
+        pshdr = struct.pack(
+            '!4s4sHH',
+            socket.inet_aton(src_ip),
+            socket.inet_aton(dst_ip),
+            socket.IPPROTO_TCP,
+            len(tcp_header) + 4
+        )
 
     checksum = get_checksum(pshdr + tcp_header)
     syn_packet = tcp_header + struct.pack('HH', checksum, 0)
@@ -251,79 +1322,1660 @@ def form_packet(src_ip, src_port, dst_ip, dst_port, seq_num, flag):
     return syn_packet
 
 
-def start_tcping_session(host, port, count, timeout, interval, WD_MODE):
+class SynTemplate:
     """
-    Initiates new tcping session, in which we will be sending
-    TCP SYN packets and trying to recieve TCP ACK.
+    Precomputed SYN packet for one (src, dst, sport, dport) tuple.
+    Only sequence number changes between probes, so the packet is built
+    once and checksum is patched incrementally (RFC 1624).
     """
 
-    global stat
-    stat = Stat()
+    seq_struct = struct.Struct('!I')
+    words_struct = struct.Struct('HH')
+    checksum_struct = struct.Struct('H')
 
-    for arg in [port, count, timeout, interval]:
-        is_positive_num(arg)
-    validate_port(port)
+    def __init__(self, src_ip, src_port, dst_ip, dst_port, flag=2):
+        self.buf = bytearray(form_packet(
+            src_ip, src_port, dst_ip, dst_port, 0, flag))
+        self.base_sum = ~self.checksum_struct.unpack_from(self.buf, 16)[0]
+        self.base_sum &= 0xffff
+
+    def packet(self, seq_num):
+        """
+        Returns preallocated buffer patched for seq_num. It is reused
+        by the next call, so send it before asking for another one.
+        """
+        self.seq_struct.pack_into(self.buf, 4, seq_num)
+        hi, lo = self.words_struct.unpack_from(self.buf, 4)
+
+        res = self.base_sum + hi + lo
+        res = (res >> 16) + (res & 0xffff)
+        res += res >> 16
 
-    src_ip = get_src_ip()
-    dst_ip = get_dst_ip(host)
+        self.checksum_struct.pack_into(self.buf, 16, (~res) & 0xffff)
+        return self.buf
 
-    if LINUX_FLAG:
 
-        soc = new_socket(timeout)
+TCP_REPLY = struct.Struct('!HHIIBB')    # src_port, dst_port, seq, ack,
+                                        # data offset, flags
+IP_SRC = struct.Struct('!4s')
+
+
+@functools.lru_cache(maxsize=1024)
+def ntoa(packed):
+    """
+    Cached inet_ntoa: replies come from few probed hosts, while
+    formatting address costs more than the rest of parsing.
+    """
+    return socket.inet_ntoa(packed)
+
+
+def unpack_reply(data):
+    """
+    Extracts (src_ip, src_port, ack_num, flags) from raw IPv4 + TCP packet.
+    TCP header is found by IHL, so IP options are skipped.
+    """
+    src_port, _, _, ack_num, _, flags = TCP_REPLY.unpack_from(
+        data, (data[0] & 0x0f) * 4)
+    return ntoa(IP_SRC.unpack_from(data, 12)[0]), src_port, ack_num, flags
+
+
+def tcp_state(flags):
+    """
+    Returns port state told by TCP flags of reply to SYN, None if
+    segment is not an answer to SYN at all.
+    """
+    if flags & 0x12 == 0x12:
+        return PORT_OPEN
+    if flags & 0x04:
+        return PORT_CLOSED
+    return None
+
+
+def unpack_icmp(data):
+    """
+    Extracts (src_port, dst_ip, dst_port, seq_num, state) of TCP segment
+    quoted in ICMP destination unreachable message (raw IPv4 + ICMP
+    packet), None for other ICMP messages.
+    """
+    ihl = (data[0] & 0x0f) * 4
+    if len(data) < ihl + 8 + 20 or data[ihl] != ICMP_DEST_UNREACH:
+        return None
+
+    quoted = ihl + 8
+    quoted_ihl = (data[quoted] & 0x0f) * 4
+    if data[quoted + 9] != socket.IPPROTO_TCP or \
+            len(data) < quoted + quoted_ihl + 8:
+        return None
+
+    src_port, dst_port, seq_num = struct.unpack_from(
+        '!HHI', data, quoted + quoted_ihl)
+    dst_ip = socket.inet_ntoa(data[quoted + 16:quoted + 20])
+
+    code = data[ihl + 1]
+    state = PORT_FILTERED if code in ICMP_FILTERED_CODES \
+        else PORT_UNREACHABLE
+    return src_port, dst_ip, dst_port, seq_num, state
+
+
+def parse_reply(data, src_ip=None):
+    """
+    Parses TCP reply to SYN into (reply_key, state). reply_key is
+    (src_port, src_ip, ack_num) of reply, equal to (port, dst_ip,
+    seq_num + 1) of the SYN it answers, so probes are kept by it.
+    state is None if segment is not an answer to SYN at all.
+    IPv6 segments come without IP header, src_ip must be given for them.
+    """
+    if src_ip is None:
+        src_ip, src_port, ack_num, flags = unpack_reply(data)
+    else:
+        src_port, _, _, ack_num, _, flags = TCP_REPLY.unpack_from(data)
+    return (src_port, src_ip, ack_num), tcp_state(flags)
+
+
+def parse_icmp_reply(data, src_port=None):
+    """
+    Parses ICMP destination unreachable into (reply_key, state) of the
+    SYN it quotes, keyed like parse_reply. Returns (None, None) for
+    other ICMP messages and SYNs not sent from src_port (if given).
+    """
+    quoted = unpack_icmp(data)
+    if quoted is None or src_port is not None and quoted[0] != src_port:
+        return None, None
+
+    _, dst_ip, dst_port, seq_num, state = quoted
+    return (dst_port, dst_ip, (seq_num + 1) & 0xffffffff), state
+
+
+def new_seq_num(pending, port, dst_ip):
+    """
+    Picks random sequence number, which reply can't be confused
+    with reply to another probe still in flight.
+    """
+    while True:
+        seq_num = random.randint(0, 1234567)
+        if (port, dst_ip, seq_num + 1) not in pending:
+            return seq_num
+
+
+class ProbeTarget:
+    """
+    Single (host, port) pair observed by ProbeEngine.
+    Up to window probes may be in flight at once, probes are sent
+    on absolute deadlines (start + n * interval), so slow or lossy
+    targets don't stretch the schedule. Host address is looked up
+    in resolver cache again every resolve_interval seconds.
+    """
+
+    resolve_interval = 1
+
+    def __init__(self, host, port, dst_ip, src_port, interval, timeout,
+                 callback, count=sys.maxsize, window=1):
+        self.host = host
+        self.port = port
+        self.src_port = src_port
+
+        self.interval = interval
+        self.timeout = timeout
+        self.callback = callback
+
+        self.count = count
+        self.window = window
+        self.sent = 0
+        self.in_flight = 0
+        self.blocked_at = None
+        self.paced_at = None
+
+        self.set_dst_ip(dst_ip)
+        self.resolve_at = time.monotonic() + self.resolve_interval
+
+        self.stopped = False
+        self.done = Event()
+
+    def set_dst_ip(self, dst_ip) -> None:
+        """
+        Points probes to dst_ip: rebuilds SYN template and raw socket
+        address, is_v6 tells which of engine sockets sends them.
+        """
+        self.dst_ip = dst_ip
+        self.is_v6 = ip_family(dst_ip) == socket.AF_INET6
+        self.address = raw_address(dst_ip, self.port)
+        self.syn_src_ip = get_src_ip(dst_ip)
+        self.template = SynTemplate(
+            self.syn_src_ip, self.src_port, dst_ip, self.port)
+
+    def refresh_dst_ip(self, now, has_v6=True) -> None:
+        """
+        Follows address changes of host, served from resolver cache
+        without waiting (cache refreshes it in background when its
+        TTL runs out). Old address is kept while lookup fails or if
+        new one is IPv6 and engine has no IPv6 socket.
+        """
+        self.resolve_at = now + self.resolve_interval
+        try:
+            dst_ip = resolver.resolve(self.host, block=False)
+        except socket.gaierror:
+            return
+        if dst_ip is None or dst_ip == self.dst_ip:
+            return
+        if not has_v6 and ip_family(dst_ip) == socket.AF_INET6:
+            return
+        self.set_dst_ip(dst_ip)
+
+    def finish_probe(self):
+        """
+        Releases window slot of completed probe. Returns deadline
+        of the probe which was waiting for this slot, if any.
+        """
+        self.in_flight -= 1
+        if self.sent >= self.count and self.in_flight == 0:
+            self.done.set()
+
+        deadline, self.blocked_at = self.blocked_at, None
+        return deadline
+
+
+class ProbeEngine:
+    """
+    Probes many (host, port) targets through one raw socket per family
+    and one poll loop. SYN-ACK and RST responses are routed back to
+    their probes by (src_port, dst_ip, ack) of the reply, ICMP
+    destination unreachable messages (IPv4 only) by the SYN they quote.
+    Sends are paced by bucket (process-wide pacer by default). Hot path
+    stages are sampled into stages (StageStats) if given. Raises OSError
+    if raw socket can't be created. IPv6 socket is optional: without
+    IPv6 support on the host only IPv4 targets can be added.
+    """
+
+    def __init__(self, timeout=1, bpf=False, timestamps=False,
+                 bucket=None, stages=None):
+        self.soc = open_raw_socket(timeout)
+        self.soc.setblocking(False)
+        try:
+            self.soc6 = open_raw_socket(timeout, socket.AF_INET6)
+            self.soc6.setblocking(False)
+        except OSError:
+            self.soc6 = None
+        self.icmp = new_icmp_socket()
+        self.buf = memoryview(bytearray(2048))
+
+        self.timestamps = timestamps
+        self.clock = get_clock(timestamps)
+        self.pacer = bucket or pacer
+        self.stages = stages or NO_STAGES
+        if timestamps:
+            for soc in [self.soc, self.soc6, self.icmp]:
+                if soc is not None:
+                    enable_timestamps(soc)
+
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+
+        self.poll = select.poll()
+        self.poll.register(self.soc, select.POLLIN)
+        self.poll.register(self.wakeup_r, select.POLLIN)
+        if self.soc6 is not None:
+            self.poll.register(self.soc6, select.POLLIN)
+        if self.icmp is not None:
+            self.poll.register(self.icmp, select.POLLIN)
+
+        self.src_port = get_avail_port(self.soc)
+        if bpf:
+            attach_bpf_filter(self.soc, self.src_port)
+        self.rejected = 0
+        self.callback_errors = 0
+        self.wakeups = self.matched = self.unmatched = 0
+        self.timeouts = self.send_errors = 0
+
+        self.targets = {}
+        self.pending = {}
+        self.schedule = []
+        self.expiries = []
+
+        self.lock = Lock()
+        self._stop_event = Event()
+        self.thread = None
+
+    def add_target(self, host, port, interval, timeout, callback,
+                   count=sys.maxsize, window=1):
+        """
+        Starts probing host:port every interval seconds.
+        callback(target, seq_num, delta, state) gets RTT in microseconds
+        (None on timeout) and port state, only PORT_OPEN means the host
+        is up. Raises ValueError for invalid arguments, socket.gaierror
+        for unknown host, OSError for IPv6 host if engine has no IPv6
+        socket.
+        """
+        check_probe_args(port, count, timeout, interval, window)
+        dst_ip = resolver.resolve(host)
+        if self.soc6 is None and ip_family(dst_ip) == socket.AF_INET6:
+            raise OSError(errno.EAFNOSUPPORT,
+                          f'{host} has IPv6 address only, no IPv6 socket')
+        target = ProbeTarget(
+            host, port, dst_ip, self.src_port, interval, timeout, callback,
+            count, window)
+
+        with self.lock:
+            old = self.targets.get((host, port))
+            if old is not None:
+                old.stopped = True
+            self.targets[(host, port)] = target
+            self.push(time.monotonic(), target)
+        self.wake()
+        return target
+
+    def remove_target(self, host, port) -> None:
+        with self.lock:
+            target = self.targets.pop((host, port), None)
+        if target is not None:
+            target.stopped = True
+            target.done.set()
+
+    def push(self, deadline, target) -> None:
+        heapq.heappush(self.schedule, (deadline, id(target), target))
+
+    def start(self) -> None:
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.wake()
+
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def wake(self) -> None:
+        """
+        Interrupts poll, so the loop notices new targets or stop.
+        """
+        os.write(self.wakeup_w, b'\0')
+
+    def send_due(self, now, timed=False) -> None:
+        stages = self.stages
+        with self.lock:
+            while self.schedule and self.schedule[0][0] <= now:
+                deadline, _, target = heapq.heappop(self.schedule)
+                if target.stopped:
+                    continue
+
+                if target.in_flight >= target.window:
+                    target.blocked_at = deadline
+                    continue
+
+                if target.paced_at is None:
+                    delay = self.pacer.reserve()
+                    if delay > 0:
+                        target.paced_at = deadline
+                        self.push(now + delay, target)
+                        continue
+                else:
+                    deadline, target.paced_at = target.paced_at, None
+
+                if now >= target.resolve_at:
+                    target.refresh_dst_ip(now, self.soc6 is not None)
+
+                if timed:
+                    start = stages.start()
+                seq_num = new_seq_num(
+                    self.pending, target.port, target.dst_ip)
+                syn_packet = target.template.packet(seq_num)
+                if timed:
+                    start = stages.lap('build', start)
+
+                soc = self.soc6 if target.is_v6 else self.soc
+                init_time = self.clock()
+                try:
+                    soc.sendto(syn_packet, target.address)
+                except socket.error:
+                    self.send_errors += 1
+                if timed:
+                    stages.lap('send', start)
+
+                reply_key = (target.port, target.dst_ip, seq_num + 1)
+                self.pending[reply_key] = (target, seq_num, init_time)
+                heapq.heappush(
+                    self.expiries,
+                    (time.monotonic() + target.timeout, reply_key))
+
+                target.sent += 1
+                target.in_flight += 1
+                if target.sent < target.count:
+                    self.push(deadline + target.interval, target)
+
+    def complete(self, probe, delta, state) -> None:
+        target, seq_num, _ = probe
+
+        with self.lock:
+            deadline = target.finish_probe()
+            if deadline is not None:
+                self.push(deadline, target)
+
+        if target.stopped:
+            return
+        try:
+            target.callback(target, seq_num, delta, state)
+        except Exception as e:
+            # failing callback must not stop probing of other targets
+            self.callback_errors += 1
+            print(f'Callback of {target.host}:{target.port} failed: {e}',
+                  file=sys.stderr)
+
+    def expire(self, now) -> None:
+        expired = []
+        with self.lock:
+            while self.expiries and self.expiries[0][0] <= now:
+                _, reply_key = heapq.heappop(self.expiries)
+                probe = self.pending.pop(reply_key, None)
+                if probe is not None:
+                    expired.append(probe)
+
+        self.timeouts += len(expired)
+        for probe in expired:
+            self.complete(probe, None, PORT_FILTERED)
+
+    def receive(self, soc, is_v6=False, timed=False) -> None:
+        stages = self.stages
+        while True:
+            if timed:
+                start = stages.start()
+            try:
+                data, recv_time, src_ip = recv_reply(
+                    soc, self.timestamps, self.buf, is_v6)
+            except (BlockingIOError, InterruptedError):
+                return
+            if timed:
+                start = stages.lap('recv', start)
+
+            reply_key, state = parse_reply(data, src_ip)
+            if timed:
+                stages.lap('parse', start)
+            if state is None:
+                self.rejected += 1
+                self.unmatched += 1
+                continue
+
+            with self.lock:
+                probe = self.pending.pop(reply_key, None)
+            if probe is None:
+                self.rejected += 1
+                self.unmatched += 1
+                continue
+
+            self.matched += 1
+            self.complete(probe, (recv_time - probe[2]) // 1000, state)
+
+    def receive_icmp(self, timed=False) -> None:
+        stages = self.stages
+        while True:
+            if timed:
+                start = stages.start()
+            try:
+                data, recv_time, _ = recv_reply(
+                    self.icmp, self.timestamps, self.buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            if timed:
+                start = stages.lap('recv', start)
+
+            reply_key, state = parse_icmp_reply(data, self.src_port)
+            if timed:
+                stages.lap('parse', start)
+            if state is None:
+                continue
+
+            with self.lock:
+                probe = self.pending.pop(reply_key, None)
+            if probe is None:
+                self.unmatched += 1
+                continue
+
+            self.matched += 1
+            self.complete(probe, (recv_time - probe[2]) // 1000, state)
+
+    def next_wakeup(self, now) -> float:
+        with self.lock:
+            deadlines = [now + 1]
+            if self.schedule:
+                deadlines.append(self.schedule[0][0])
+            if self.expiries:
+                deadlines.append(self.expiries[0][0])
+        return max(0, min(deadlines) - now)
+
+    def run(self) -> None:
+        """
+        Loop of engine thread. Stages of sampled iterations are timed,
+        event counts are added to stages when engine stops.
+        """
+        stages = self.stages
+        counted = stages.enabled
+        rate = stages.rate
+        while not self.stopped():
+            now = time.monotonic()
+            timed = counted and random.random() < rate
+            self.send_due(now, timed)
+            self.expire(now)
+
+            if timed:
+                start = stages.start()
+            events = self.poll.poll(self.next_wakeup(time.monotonic()) * 1000)
+            if timed:
+                stages.lap('poll', start)
+            if events:
+                self.wakeups += 1
+            for fd, _ in events:
+                if fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 512)
+                elif self.icmp is not None and fd == self.icmp.fileno():
+                    self.receive_icmp(timed)
+                elif self.soc6 is not None and fd == self.soc6.fileno():
+                    self.receive(self.soc6, True, timed)
+                else:
+                    self.receive(self.soc, False, timed)
+        stages.add_counts(self.wakeups, self.matched, self.unmatched,
+                          self.timeouts, self.send_errors)
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes sockets and wakeup pipe, run() does it on stop. Only
+        needed for engine that was never started.
+        """
+        for soc in [self.soc, self.soc6, self.icmp]:
+            if soc is not None:
+                soc.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+
+class AsyncProbeEngine:
+    """
+    Shares one non-blocking raw socket of address family between all
+    probe() generators running in the same event loop. The socket is
+    watched with loop.add_reader and closed when the last generator
+    is done. SYN-ACK, RST and (for IPv4, if permitted) ICMP destination
+    unreachable replies finish probes. Raises OSError if raw socket
+    can't be created.
+    """
+
+    engines = weakref.WeakKeyDictionary()   # loop -> {family: engine}
+
+    def __init__(self, loop, family=socket.AF_INET) -> None:
+        self.loop = loop
+        self.family = family
+
+        self.soc = open_raw_socket(1, family)
+        self.soc.setblocking(False)
+        self.icmp = new_icmp_socket() if family == socket.AF_INET else None
+
+        self.pending = {}
+        self.users = 0
+        self.buf = memoryview(bytearray(2048))
+        loop.add_reader(self.soc.fileno(), self.receive)
+        if self.icmp is not None:
+            loop.add_reader(self.icmp.fileno(), self.receive_icmp)
+
+    @classmethod
+    def acquire(cls, loop, family=socket.AF_INET):
+        engine = cls.engines.get(loop, {}).get(family)
+        if engine is None:
+            engine = cls(loop, family)
+            cls.engines.setdefault(loop, {})[family] = engine
+        engine.users += 1
+        return engine
+
+    def release(self) -> None:
+        self.users -= 1
+        if self.users == 0:
+            engines = self.engines[self.loop]
+            del engines[self.family]
+            if not engines:
+                del self.engines[self.loop]
+            self.loop.remove_reader(self.soc.fileno())
+            self.soc.close()
+            if self.icmp is not None:
+                self.loop.remove_reader(self.icmp.fileno())
+                self.icmp.close()
+
+    def receive(self) -> None:
+        while True:
+            try:
+                data, recv_time, src_ip = recv_reply(
+                    self.soc, False, self.buf, self.family == socket.AF_INET6)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.complete(*parse_reply(data, src_ip), recv_time)
+
+    def receive_icmp(self) -> None:
+        while True:
+            try:
+                data, recv_time, _ = recv_reply(self.icmp, False, self.buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.complete(*parse_icmp_reply(data), recv_time)
+
+    def complete(self, reply_key, state, recv_time) -> None:
+        if state is None:
+            return
+        probe = self.pending.pop(reply_key, None)
+        if probe is not None:
+            aprobe, seq_num, init_time = probe
+            rtt = (recv_time - init_time) // 1000
+            aprobe.reply(reply_key, seq_num, rtt, state)
+
+
+class AsyncProbe:
+    """
+    State of single probe() generator: sends are scheduled with
+    loop timers on absolute deadlines, results go to the queue.
+    Every generator uses its own source port, so concurrent sessions
+    to the same host:port don't share a TCP 4-tuple.
+    """
+
+    def __init__(self, engine, host, dst_ip, port, count, timeout,
+                 interval, window) -> None:
+        self.engine = engine
+        self.loop = engine.loop
+
+        self.host = host
+        self.dst_ip = dst_ip
+        self.port = port
+
+        self.count = count
+        self.timeout = timeout
+        self.interval = interval
+        self.window = window
+
+        self.template = SynTemplate(
+            get_src_ip(dst_ip), random.randint(49152, 65535), dst_ip, port)
+        import asyncio
+        self.results = asyncio.Queue()
+
+        self.sent = 0
+        self.in_flight = 0
+        self.blocked_at = None
+        self.send_timer = None
+        self.expiries = {}
+
+    def start(self) -> None:
+        self.send(self.loop.time())
+
+    def send(self, deadline, paced=False) -> None:
+        if self.in_flight >= self.window:
+            self.blocked_at = deadline
+            return
+
+        if not paced:
+            delay = pacer.reserve()
+            if delay > 0:
+                self.send_timer = self.loop.call_later(
+                    delay, self.send, deadline, True)
+                return
+
+        seq_num = new_seq_num(self.engine.pending, self.port, self.dst_ip)
+        syn_packet = self.template.packet(seq_num)
+
+        init_time = time.monotonic_ns()
+        try:
+            self.engine.soc.sendto(syn_packet,
+                                   raw_address(self.dst_ip, self.port))
+        except socket.error:
+            pass
+
+        reply_key = (self.port, self.dst_ip, seq_num + 1)
+        self.engine.pending[reply_key] = (self, seq_num, init_time)
+        self.expiries[reply_key] = self.loop.call_later(
+            self.timeout, self.expire, reply_key, seq_num)
+
+        self.sent += 1
+        self.in_flight += 1
+        if self.sent < self.count:
+            deadline += self.interval
+            self.send_timer = self.loop.call_at(deadline, self.send, deadline)
+
+    def expire(self, reply_key, seq_num) -> None:
+        del self.expiries[reply_key]
+        if self.engine.pending.pop(reply_key, None) is not None:
+            self.finish(seq_num, None, PORT_FILTERED)
+
+    def reply(self, reply_key, seq_num, rtt, state) -> None:
+        self.expiries.pop(reply_key).cancel()
+        self.finish(seq_num, rtt, state)
+
+    def finish(self, seq_num, rtt, state) -> None:
+        self.in_flight -= 1
+        self.results.put_nowait(ProbeResult(
+            self.host, self.dst_ip, self.port, seq_num, rtt, state))
+
+        if self.blocked_at is not None:
+            deadline, self.blocked_at = self.blocked_at, None
+            self.send(deadline)
+
+    def close(self) -> None:
+        if self.send_timer is not None:
+            self.send_timer.cancel()
+        for reply_key, timer in self.expiries.items():
+            timer.cancel()
+            self.engine.pending.pop(reply_key, None)
+        self.expiries.clear()
+
+
+async def probe(host, port, count=sys.maxsize, timeout=0.5, interval=1,
+                window=1):
+    """
+    Asynchronous tcping session, yields ProbeResult for every probe:
+
+        async for result in tcping.probe('dns.yandex', 53, count=5):
+            print(result.rtt)
+
+    All generators in one event loop share a single raw socket per
+    address family. Raises ValueError for invalid arguments,
+    socket.gaierror for unknown host and OSError (PermissionError
+    without root) if raw socket can't be created.
+    """
+    check_probe_args(port, count, timeout, interval, window)
+
+    import asyncio
+    loop = asyncio.get_running_loop()
+    dst_ip = await resolver.resolve_async(host)
+
+    engine = AsyncProbeEngine.acquire(loop, ip_family(dst_ip))
+    aprobe = AsyncProbe(
+        engine, host, dst_ip, port, count, timeout, interval, window)
+    try:
+        aprobe.start()
+        for _ in range(count):
+            yield await aprobe.results.get()
+    finally:
+        aprobe.close()
+        engine.release()
+
+
+def record_probe(result, stat, writer):
+    """
+    Saves result of single probe to stat and writes it out.
+    """
+    stat.send += 1
+    if result.ok:
+        stat.recv += 1
+        stat.add_delta(result.rtt)
+    writer.write(result)
+
+
+class Session:
+    """
+    Single tcping session. It owns its socket, poller, Stat and
+    config, so any number of sessions may run in parallel threads.
+    Results go to output writer (TableWriter on stdout by default),
+    run() returns the Stat. With debug_stats hot path stages are
+    timed into session.stages (StageStats). mode is one of MODES,
+    picked by default_mode() if not given.
+    Raises ValueError for invalid arguments, run() raises
+    socket.gaierror for unknown host and OSError if socket can't be
+    created, so sessions can run in worker threads (see run_session()
+    for the CLI way).
+    """
+
+    def __init__(self, host, port, count=sys.maxsize, timeout=0.5,
+                 interval=1, window=1, bpf=False, timestamps=False,
+                 output=None, wd_mode=False, debug_stats=False,
+                 mode=None) -> None:
+        check_probe_args(port, count, timeout, interval, window)
+
+        self.host = host
+        self.port = port
+        self.count = count
+        self.timeout = timeout
+        self.interval = interval
+        self.window = window
+        self.bpf = bpf
+        self.timestamps = timestamps
+        self.wd_mode = wd_mode
+        self.mode = mode or default_mode()
+
+        self.stat = Stat()
+        self.stages = StageStats() if debug_stats else None
+        self.writer = TableWriter() if output is None else output
+        self.dst_ip = None
+        self._stop_event = Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def stopped(self) -> bool:
+        if self.wd_mode and getattr(current_thread(), 'stopped', None):
+            return self._stop_event.is_set() or current_thread().stopped()
+        return self._stop_event.is_set()
+
+    def record(self, result) -> None:
+        if self.wd_mode:
+            wd_states.publish((self.host, self.port), result.ok)
+            return
+        record_probe(result, self.stat, self.writer)
+
+    def report(self, target, seq_num, delta, state) -> None:
+        """
+        ProbeEngine callback for pipelined session.
+        """
+        self.record(ProbeResult(
+            target.host, target.dst_ip, target.port, seq_num, delta, state))
+
+    def run(self) -> Stat:
+        self.dst_ip = resolver.resolve(self.host)
+        try:
+            if self.mode == MODE_CONNECT:
+                self.run_connect()
+            elif self.mode == MODE_SCAPY:
+                self.run_scapy()
+            elif self.window > 1 and not self.wd_mode:
+                self.run_pipelined()
+            else:
+                self.run_raw()
+        finally:
+            if not self.wd_mode:
+                self.print_summary()
+        return self.stat
+
+    def print_summary(self) -> None:
+        self.writer.summary(self.stat)
+        if self.bpf and isinstance(self.writer, TableWriter):
+            print(f'Packets rejected in userspace: {self.stat.rejected}',
+                  file=self.writer.stream)
+
+    def run_pipelined(self) -> None:
+        """
+        Sends probes on a fixed schedule keeping up to window of them
+        in flight, instead of waiting for each response in turn.
+        """
+        engine = ProbeEngine(self.timeout, self.bpf, self.timestamps,
+                             stages=self.stages)
+        target = engine.add_target(
+            self.host, self.port, self.interval, self.timeout, self.report,
+            self.count, self.window)
+
+        engine.start()
+        try:
+            while not target.done.wait(0.1):
+                if self.stopped():
+                    break
+        finally:
+            engine.stop()
+            engine.thread.join()
+            self.stat.rejected = engine.rejected
+
+    def run_raw(self) -> None:
+        host, port, dst_ip = self.host, self.port, self.dst_ip
+        src_ip = get_src_ip(dst_ip)
+        is_v4 = ip_family(dst_ip) == socket.AF_INET
+
+        soc = open_raw_socket(self.timeout, ip_family(dst_ip))
+        icmp = new_icmp_socket() if is_v4 else None
+        if self.timestamps:
+            enable_timestamps(soc)
+            if icmp is not None:
+                enable_timestamps(icmp)
 
         poll = select.poll()
         poll.register(soc, select.POLLIN)
+        if icmp is not None:
+            poll.register(icmp, select.POLLIN)
 
         src_port = get_avail_port(soc)
+        if self.bpf and is_v4:
+            attach_bpf_filter(soc, src_port, dst_ip)
+        template = SynTemplate(src_ip, src_port, dst_ip, port)
+        stages = self.stages or NO_STAGES
+        counted = stages.enabled
+        rate = stages.rate
+        buf = memoryview(bytearray(2048))
 
-        for _ in range(0, count):
-            if WD_MODE and current_thread().stopped():
-                print(f'Stopped daemon responsible for {host}')
-                break
+        try:
+            for _ in range(0, self.count):
+                if self.stopped():
+                    if self.wd_mode:
+                        print(f'Stopped daemon responsible for {host}')
+                    break
+
+                timed = counted and random.random() < rate
+                if timed:
+                    start = stages.start()
+                seq_num = random.randint(0, 1234567)
+                syn_packet = template.packet(seq_num)
+                if timed:
+                    stages.lap('build', start)
+                pacer.acquire()
+
+                delta, state = get_response(
+                    soc,
+                    syn_packet,
+                    dst_ip,
+                    port,
+                    seq_num,
+                    self.stat,
+                    poll,
+                    self.timestamps,
+                    stages,
+                    icmp,
+                    buf,
+                    src_port)
+                self.record(
+                    ProbeResult(host, dst_ip, port, seq_num, delta, state))
+                self._stop_event.wait(self.interval)
+        finally:
+            soc.close()
+            if icmp is not None:
+                icmp.close()
+
+    def run_connect(self) -> None:
+        """
+        Times TCP handshakes with non-blocking connect(), no root needed.
+        """
+        results = connect_sweep(
+            itertools.repeat((self.dst_ip, self.port), self.count),
+            self.timeout, self.interval, self.window, self.stages)
+        try:
+            for result in results:
+                result.host = self.host
+                self.record(result)
+                if self.stopped():
+                    break
+        finally:
+            results.close()
 
-            seq_num = random.randint(0, 1234567)
-            syn_packet = form_packet(src_ip, src_port, dst_ip, port, seq_num, 2)
-
-            get_response(
-                soc,
-                syn_packet,
-                dst_ip,
-                port,
-                seq_num,
-                stat,
-                WD_MODE,
-                poll)
-            sleep(interval)
+    def run_scapy(self) -> None:
+        from scapy.all import IP, TCP, srloop
 
-        soc.close()
+        host, port, dst_ip = self.host, self.port, self.dst_ip
+        timeout, interval = self.timeout, self.interval
 
-    else:
         ip=IP(dst=dst_ip)
         src_port = get_avail_port(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
         
-        for _ in range(count):
+        for _ in range(self.count):
+            if self.stopped():
+                break
 
             seq_num = random.randint(0, 1234567)
             SYN=TCP(sport=src_port, dport=port, flags='S', seq=seq_num)
             
-            init_time = time.time()
+            pacer.acquire()
+            init_time = time.monotonic_ns()
 
-            stat.send += 1
             ans, _ = srloop(ip/SYN, timeout=timeout, inter=interval, verbose=False, count=1)
 
-            if not ans:
-                print('Unable to get a response from ' +
-                  f'target host: {dst_ip}:[{port}]')
+            delta = None
+            if ans:
+               delta = (time.monotonic_ns() - init_time) // 1000
+            self.record(ProbeResult(host, dst_ip, port, seq_num, delta))
+
+
+def start_tcping_session(host, port, count, timeout, interval, WD_MODE,
+                         window=1, bpf=False, timestamps=False, output=None):
+    """
+    Initiates new tcping session, in which we will be sending
+    TCP SYN packets and trying to recieve TCP ACK.
+    Returns Stat of the session.
+    """
+    for arg in [port, count, timeout, interval, window]:
+        is_positive_num(arg)
+    validate_port(port)
+
+    session = Session(host, port, count, timeout, interval, window, bpf,
+                      timestamps, output, WD_MODE)
+    return run_session(session)
+
+
+def run_session(session):
+    """
+    Runs session the CLI way: unknown host and socket errors are
+    printed and exit with codes 5 and 4. Returns Stat of the session.
+    """
+    try:
+        return session.run()
+    except socket.gaierror:
+        print('Can\'t get IP address for this domain name')
+        sys.exit(5)
+    except OSError as err:
+        print('Unable to probe due to socket error: ', err)
+        sys.exit(4)
+
+
+def parse_ports(arg):
+    """
+    Parses port list like '22,80,443,8000-8100' into list of
+    (first, last) ranges. Single port is returned as plain int.
+    """
+    if arg.isdigit():
+        return int(arg)
+
+    ranges = []
+    for part in arg.split(','):
+        first, _, last = part.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Invalid port list: {arg}')
+        ranges.append((first, last))
+    return ranges
+
+
+def validate_ports(ranges):
+    for first, last in ranges:
+        validate_port(first)
+        validate_port(last)
+        if first > last:
+            print(f'Port range {first}-{last} is empty')
+            sys.exit(3)
+
+
+def iter_targets(host, ranges):
+    """
+    Lazily yields every (dst_ip, port) pair of CIDR network
+    (or single host) and port ranges, ports are the outer loop,
+    so consecutive probes go to different addresses.
+    """
+    if '/' in host:
+        try:
+            network = ipaddress.ip_network(host, strict=False)
+        except ValueError:
+            print(f'Invalid network: {host}')
+            sys.exit(5)
+        addresses = network.hosts
+    else:
+        dst_ip = get_dst_ip(host)
+        addresses = lambda: [dst_ip]
+
+    for first, last in ranges:
+        for port in range(first, last + 1):
+            for address in addresses():
+                yield str(address), port
+
+
+def drain(soc, buf, clock=time.monotonic_ns, is_v6=False):
+    """
+    Yields (packet, receive time in ns, source IP) until non-blocking
+    socket has no more of them. Source IP is only read for IPv6, like
+    in recv_reply(). Packets are received into buf and yielded as
+    memoryview of it, valid until the next one.
+    """
+    view = memoryview(buf)
+    src_ip = None
+    while True:
+        try:
+            if is_v6:
+                nbytes, address = soc.recvfrom_into(buf)
+                src_ip = address[0]
+            else:
+                nbytes = soc.recv_into(buf)
+        except (BlockingIOError, InterruptedError):
+            return
+        yield view[:nbytes], clock(), src_ip
+
+
+class SweepScheduler:
+    """
+    Pacing, windowing and timeouts shared by sweep() and connect_sweep().
+    Hands out targets not faster than interval and the global pacer allow,
+    while fewer than window probes are pending. Pending probes are kept
+    by key with their timeouts in FIFO order, as all of them have the
+    same timeout.
+    """
+
+    def __init__(self, targets, timeout, interval, window) -> None:
+        self.targets = iter(targets)
+        self.timeout = timeout
+        self.interval = interval
+        self.window = window
+
+        self.pending = {}
+        self.expiries = collections.deque()
+        self.next_target = next(self.targets, None)
+        self.next_send = time.monotonic()
+        self.paced = False
+
+    def done(self) -> bool:
+        return self.next_target is None and not self.pending
+
+    def can_send(self) -> bool:
+        return self.next_target is not None and \
+            len(self.pending) < self.window
+
+    def due(self, now):
+        """
+        Yields targets to probe now. Probes which get an answer
+        should be added before the next one is taken.
+        """
+        while self.can_send() and self.next_send <= now:
+            if not self.paced:
+                delay = pacer.reserve()
+                if delay > 0:
+                    self.paced = True
+                    self.next_send = now + delay
+                    return
+            self.paced = False
+
+            target = self.next_target
+            self.next_send = max(self.next_send, now - self.interval) + \
+                self.interval
+            self.next_target = next(self.targets, None)
+            yield target
+
+    def add(self, key, value, now) -> None:
+        self.pending[key] = value
+        self.expiries.append((now + self.timeout, key))
+
+    def pop(self, key):
+        return self.pending.pop(key, None)
+
+    def expired(self, now):
+        """
+        Yields (key, value) of pending probes timed out by now.
+        """
+        while self.expiries and self.expiries[0][0] <= now:
+            _, key = self.expiries.popleft()
+            value = self.pending.pop(key, None)
+            if value is not None:
+                yield key, value
+
+    def wait_time(self, now) -> float:
+        """
+        Seconds until the next target is due or probe expires, at most 1.
+        """
+        deadlines = [now + 1]
+        if self.expiries:
+            deadlines.append(self.expiries[0][0])
+        if self.can_send():
+            deadlines.append(self.next_send)
+        return max(0, min(deadlines) - now)
+
+
+def sweep(targets, timeout, interval, window, bpf=False, stages=None,
+          ring=False, src_ports=None):
+    """
+    Sends one SYN to every (dst_ip, port) of targets iterator through
+    one raw socket, keeping up to window probes in flight. Yields
+    ProbeResult as answers arrive, state is one of PORT_OPEN (SYN-ACK),
+    PORT_CLOSED (RST), PORT_UNREACHABLE (ICMP destination unreachable)
+    or PORT_FILTERED (timeout or ICMP prohibited).
+    Memory is bounded by window, not by number of targets.
+    With ring, TCP replies are read from PacketRing instead of
+    the raw socket, which gets a drop-all filter. Source port is
+    taken from src_ports range, if given.
+    IPv6 targets are swept through IPv6 raw socket, without BPF filter
+    and ICMP, and can't be read from the ring (IPv4 only). All targets
+    must be of the same family as the first one.
+    """
+    stages = stages or NO_STAGES
+    counted = stages.enabled
+    rate = stages.rate
+    targets = iter(targets)
+    first = next(targets, None)
+    if first is None:
+        return
+    scheduler = SweepScheduler(
+        itertools.chain([first], targets), timeout, interval, window)
+
+    family = ip_family(first[0])
+    is_v6 = family == socket.AF_INET6
+    if ring and is_v6:
+        print('Packet ring only captures IPv4, sweep IPv6 without --ring')
+        sys.exit(4)
+
+    soc = new_socket(timeout, family)
+    soc.setblocking(False)
+    src_ip = get_src_ip(first[0])
+    src_port = get_avail_port(soc, src_ports)
+    clock = time.monotonic_ns
+
+    packet_ring = None
+    if ring:
+        packet_ring = PacketRing(src_port)
+        set_bpf_program(soc, [(BPF_RET_K, 0, 0, 0)])
+        clock = time.time_ns
+    elif bpf and not is_v6:
+        attach_bpf_filter(soc, src_port)
+
+    icmp = None if is_v6 else new_icmp_socket()
+
+    poll = select.poll()
+    poll.register(packet_ring or soc, select.POLLIN)
+    if icmp is not None:
+        poll.register(icmp, select.POLLIN)
+
+    buf = bytearray(2048)
+    wakeups = matched = unmatched = timeouts = send_errors = 0
+
+    try:
+        while not scheduler.done():
+            now = time.monotonic()
+            timed = counted and random.random() < rate
+            for dst_ip, port in scheduler.due(now):
+                if timed:
+                    start = stages.start()
+                seq_num = new_seq_num(scheduler.pending, port, dst_ip)
+                syn_packet = form_packet(
+                    src_ip, src_port, dst_ip, port, seq_num, 2)
+                if timed:
+                    start = stages.lap('build', start)
+
+                init_time = clock()
+                try:
+                    soc.sendto(syn_packet, raw_address(dst_ip, port))
+                except socket.error:
+                    send_errors += 1
+                if timed:
+                    stages.lap('send', start)
+
+                scheduler.add((port, dst_ip, seq_num + 1), init_time, now)
+
+            for reply_key, _ in scheduler.expired(now):
+                timeouts += 1
+                port, dst_ip, ack_num = reply_key
+                yield ProbeResult(
+                    dst_ip, dst_ip, port, ack_num - 1, None, PORT_FILTERED)
+
+            if timed:
+                start = stages.start()
+            events = poll.poll(int(scheduler.wait_time(now) * 1000))
+            if timed:
+                stages.lap('poll', start)
+            if not events:
+                continue
+            wakeups += 1
+
+            for fd, _ in events:
+                is_icmp = icmp is not None and fd == icmp.fileno()
+                if is_icmp:
+                    packets = drain(icmp, buf, clock)
+                elif packet_ring is not None:
+                    packets = packet_ring.packets()
+                else:
+                    packets = drain(soc, buf, clock, is_v6)
+
+                if timed:
+                    start = stages.start()
+                for data, recv_time, reply_ip in packets:
+                    if timed:
+                        start = stages.lap('recv', start)
+
+                    if is_icmp:
+                        reply_key, state = parse_icmp_reply(data, src_port)
+                    else:
+                        reply_key, state = parse_reply(data, reply_ip)
+                    if timed:
+                        start = stages.lap('parse', start)
+                    if state is None:
+                        unmatched += 1
+                        continue
+
+                    init_time = scheduler.pop(reply_key)
+                    if init_time is None:
+                        unmatched += 1
+                    else:
+                        matched += 1
+                        reply_port, reply_ip, ack_num = reply_key
+                        rtt = (recv_time - init_time) // 1000
+                        yield ProbeResult(reply_ip, reply_ip, reply_port,
+                                          ack_num - 1, rtt, state)
+                        if timed:
+                            start = stages.start()
+    finally:
+        stages.add_counts(wakeups, matched, unmatched, timeouts, send_errors)
+        soc.close()
+        if packet_ring is not None:
+            packet_ring.close()
+        if icmp is not None:
+            icmp.close()
+
+
+def connect_sweep(targets, timeout, interval, window, stages=None):
+    """
+    Unprivileged counterpart of sweep(): measures TCP handshake time
+    with non-blocking connect() calls multiplexed on one selector
+    (epoll on Linux), keeping up to window of them in flight. Sockets
+    are closed with SO_LINGER 0, so they are reset at once and leave
+    no TIME_WAIT behind. Yields ProbeResult as handshakes finish, state
+    is PORT_OPEN (connected), PORT_CLOSED (refused) or PORT_FILTERED
+    (timeout or other error); rtt is set for open ports only.
+    """
+    stages = stages or NO_STAGES
+    counted = stages.enabled
+    rate = stages.rate
+    scheduler = SweepScheduler(targets, timeout, interval, window)
+    selector = selectors.DefaultSelector()
+    linger = struct.pack('ii', 1, 0)
+    seq_num = 0
+    wakeups = matched = unmatched = timeouts = send_errors = 0
+
+    def finish(soc):
+        selector.unregister(soc)
+        soc.close()
+
+    try:
+        while not scheduler.done():
+            now = time.monotonic()
+            timed = counted and random.random() < rate
+            for dst_ip, port in scheduler.due(now):
+                seq_num += 1
+
+                if timed:
+                    start = stages.start()
+                soc = socket.socket(ip_family(dst_ip), socket.SOCK_STREAM)
+                soc.setblocking(False)
+                soc.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, linger)
+                if timed:
+                    start = stages.lap('build', start)
+
+                init_time = time.monotonic_ns()
+                err = soc.connect_ex((dst_ip, port))
+                if timed:
+                    stages.lap('send', start)
+
+                if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    selector.register(soc, selectors.EVENT_WRITE)
+                    scheduler.add(soc, (dst_ip, port, seq_num, init_time), now)
+                else:
+                    soc.close()
+                    send_errors += 1
+                    state = PORT_CLOSED if err == errno.ECONNREFUSED \
+                        else PORT_FILTERED
+                    yield ProbeResult(
+                        dst_ip, dst_ip, port, seq_num, None, state)
+
+            for soc, probe in scheduler.expired(now):
+                timeouts += 1
+                finish(soc)
+                dst_ip, port, probe_seq, _ = probe
+                yield ProbeResult(dst_ip, dst_ip, port, probe_seq, None,
+                                  PORT_FILTERED)
+
+            if timed:
+                start = stages.start()
+            if scheduler.pending:
+                events = selector.select(scheduler.wait_time(now))
             else:
-               stat.recv +=1
-               delta = round((time.time() - init_time) * 1000)
-               stat.add_delta(delta)
-               print(
-                    f'OK! Got response from {dst_ip}:[{port}]' +
-                    f' : seq = {seq_num}, time = {delta}ms')
+                sleep(scheduler.wait_time(now))
+                events = []
+            recv_time = time.monotonic_ns()
+            if timed:
+                stages.lap('poll', start)
+            if events:
+                wakeups += 1
+
+            for key, _ in events:
+                if timed:
+                    start = stages.start()
+                soc = key.fileobj
+                err = soc.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                dst_ip, port, probe_seq, init_time = scheduler.pop(soc)
+                finish(soc)
+                if timed:
+                    stages.lap('recv', start)
+
+                if err == 0:
+                    matched += 1
+                    yield ProbeResult(
+                        dst_ip, dst_ip, port, probe_seq,
+                        (recv_time - init_time) // 1000, PORT_OPEN)
+                else:
+                    unmatched += 1
+                    state = PORT_CLOSED if err == errno.ECONNREFUSED \
+                        else PORT_FILTERED
+                    yield ProbeResult(
+                        dst_ip, dst_ip, port, probe_seq, None, state)
+    finally:
+        stages.add_counts(wakeups, matched, unmatched, timeouts, send_errors)
+        for soc in scheduler.pending:
+            soc.close()
+        selector.close()
+
+
+def race(addresses, port, timeout):
+    """
+    Sends SYN to every address (IPv4 and IPv6 mixed) at once, through
+    one raw socket per family watched by one poll loop. Yields
+    ProbeResult as answers arrive, so the fastest address comes first;
+    unanswered ones are yielded as filtered after timeout.
+    """
+    sockets = {}
+    by_fd = {}
+    pending = {}
+    poll = select.poll()
+    buf = memoryview(bytearray(2048))
 
-    if not WD_MODE:
-        stat.print()
+    try:
+        probes = []
+        for dst_ip in addresses:
+            family = ip_family(dst_ip)
+            if family not in sockets:
+                soc = new_socket(timeout, family)
+                soc.setblocking(False)
+                poll.register(soc, select.POLLIN)
+                sockets[family] = soc, get_avail_port(soc)
+                by_fd[soc.fileno()] = soc, family == socket.AF_INET6
+
+            soc, src_port = sockets[family]
+            seq_num = new_seq_num(pending, port, dst_ip)
+            pending[(port, dst_ip, seq_num + 1)] = None
+            syn_packet = form_packet(
+                get_src_ip(dst_ip), src_port, dst_ip, port, seq_num, 2)
+            probes.append((soc, syn_packet, dst_ip, seq_num))
+
+        for soc, syn_packet, dst_ip, seq_num in probes:
+            init_time = time.monotonic_ns()
+            try:
+                soc.sendto(syn_packet, raw_address(dst_ip, port))
+            except socket.error:
+                pass
+            pending[(port, dst_ip, seq_num + 1)] = init_time
+
+        deadline = time.monotonic() + timeout
+        while pending:
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                break
+
+            for fd, _ in poll.poll(wait * 1000):
+                soc, is_v6 = by_fd[fd]
+                while True:
+                    try:
+                        data, recv_time, src_ip = recv_reply(
+                            soc, False, buf, is_v6)
+                    except (BlockingIOError, InterruptedError):
+                        break
+
+                    reply_key, state = parse_reply(data, src_ip)
+                    if state is None:
+                        continue
+                    init_time = pending.pop(reply_key, None)
+                    if init_time is None:
+                        continue
+
+                    src_port, reply_ip, ack_num = reply_key
+                    rtt = (recv_time - init_time) // 1000
+                    yield ProbeResult(reply_ip, reply_ip, src_port,
+                                      ack_num - 1, rtt, state)
+
+        for _, dst_ip, ack_num in pending:
+            yield ProbeResult(
+                dst_ip, dst_ip, port, ack_num - 1, None, PORT_FILTERED)
+    finally:
+        for soc, _ in by_fd.values():
+            soc.close()
+
+
+def start_race(host, port, count, timeout, interval, output=None):
+    """
+    Resolves every address of host with getaddrinfo and races them
+    count times. Results are written as they arrive, then per-address
+    summary with the fastest address and its family.
+    Returns dict of Stat by address.
+    """
+    for arg in [port, count, timeout, interval]:
+        is_positive_num(arg)
+    validate_port(port)
+
+    writer = TableWriter() if output is None else output
+    addresses = resolve_all(host)
+    stats = {dst_ip: Stat() for dst_ip in addresses}
+    total = Stat()
+
+    try:
+        for num in range(count):
+            if num:
+                sleep(interval)
+            for result in race(addresses, port, timeout):
+                result.host = host
+                stats[result.dst_ip].send += 1
+                if result.ok:
+                    stats[result.dst_ip].recv += 1
+                    stats[result.dst_ip].add_delta(result.rtt)
+                writer.write(result)
+    finally:
+        for stat in stats.values():
+            total.merge(stat)
+        writer.summary(total)
+        if isinstance(writer, TableWriter):
+            print(draw_race(stats), file=writer.stream)
+    return stats
+
+
+def draw_race(stats) -> str:
+    """
+    Returns table of per-address statistics of race and fastest
+    address (by average RTT).
+    """
+    from texttable import Texttable
+    table = Texttable(max_width=150)
+    rows = [['Address', 'Family', 'Avg', 'P99', 'Sent', 'Recieved']]
+
+    fastest = None
+    for dst_ip, stat in stats.items():
+        family = 'IPv6' if ip_family(dst_ip) == socket.AF_INET6 else 'IPv4'
+        rows.append([dst_ip, family, format_time(stat.get_avg_time()),
+                     format_time(stat.get_percentile(99)), stat.send,
+                     stat.recv])
+        if stat.recv and (fastest is None or
+                          stat.get_avg_time() < fastest[2]):
+            fastest = (dst_ip, family, stat.get_avg_time())
+
+    table.add_rows(rows)
+    res = table.draw() + '\n'
+    if fastest is not None:
+        res += f'Fastest: {fastest[0]} ({fastest[1]})\n'
+    return res
+
+
+def shard_ports(shard, workers):
+    """
+    Returns source port range of sweep worker shard, ranges of
+    all workers are disjoint slices of dynamic ports 49152-65535.
+    """
+    size = (65536 - 49152) // workers
+    first = 49152 + shard * size
+    return range(first, first + size)
+
+
+def sweep_results(host, ranges, timeout, interval, window, bpf=False,
+                  stages=None, mode=None, ring=False, shard=0, workers=1):
+    """
+    Returns iterator of ProbeResult for every shard-th of each workers
+    targets of the sweep, probed by connect() or raw socket sweep.
+    Sharded raw sweeps always get BPF filter, otherwise every worker
+    would receive and parse replies to all of them.
+    """
+    targets = iter_targets(host, ranges)
+    if workers > 1:
+        targets = itertools.islice(targets, shard, None, workers)
+
+    if (mode or default_mode()) == MODE_CONNECT:
+        return connect_sweep(targets, timeout, interval, window, stages)
+    if workers == 1:
+        return sweep(targets, timeout, interval, window, bpf, stages, ring)
+    return sweep(targets, timeout, interval, window, True, stages, ring,
+                 shard_ports(shard, workers))
+
+
+def sweep_worker(queue, shard, workers, pacing, args, kwargs, debug_stats,
+                 batch=256, flush_interval=0.1):
+    """
+    Body of sweep worker process. Probes its shard of targets and
+    streams results to the parent by queue in batches of compact
+    (dst_ip, port, seq, rtt, state, time) tuples, flushed when batch
+    is full or flush_interval has passed. Ends with ('done', Stat,
+    StageStats or None) message, ('error', message) if sweep failed.
+    """
+    resolver.after_fork()
+    pps, burst, jitter = pacing
+    pacer.configure(pps / workers, burst, jitter)
+    stat = Stat()
+    stages = StageStats() if debug_stats else None
+    results = []
+    last_flush = time.monotonic()
+
+    try:
+        for result in sweep_results(*args, stages=stages, shard=shard,
+                                    workers=workers, **kwargs):
+            stat.send += 1
+            if result.ok:
+                stat.recv += 1
+                stat.add_delta(result.rtt)
+            results.append((result.dst_ip, result.port, result.seq_num,
+                            result.rtt, result.state, result.time))
+
+            if len(results) >= batch or \
+                    time.monotonic() - last_flush > flush_interval:
+                queue.put(('results', results))
+                results = []
+                last_flush = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    except (OSError, SystemExit) as e:
+        queue.put(('results', results))
+        queue.put(('error', f'worker {shard}: {e}'))
+        return
+
+    queue.put(('results', results))
+    queue.put(('done', stat, stages))
+
+
+def sharded_sweep(args, kwargs, workers, stat, writer, stages=None):
+    """
+    Runs sweep_results(*args, **kwargs) in workers processes, each
+    one with its own socket, source port range and shard of targets.
+    Results are written as batches arrive, worker Stat (and
+    StageStats) are merged into stat (and stages).
+    """
+    import multiprocessing
+
+    queue = multiprocessing.Queue()
+    pacing = (pacer.pps, pacer.burst, pacer.jitter)
+    processes = [
+        multiprocessing.Process(
+            target=sweep_worker, daemon=True,
+            args=(queue, shard, workers, pacing, args, kwargs,
+                  stages is not None))
+        for shard in range(workers)]
+    for process in processes:
+        process.start()
+
+    running = workers
+    try:
+        while running:
+            try:
+                message = queue.get(timeout=0.5)
+            except Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+
+            if message[0] == 'results':
+                for dst_ip, port, seq_num, rtt, state, timestamp in \
+                        message[1]:
+                    writer.write(ProbeResult(dst_ip, dst_ip, port, seq_num,
+                                             rtt, state, timestamp))
+                continue
+
+            running -= 1
+            if message[0] == 'done':
+                stat.merge(message[1])
+                if stages is not None:
+                    stages.merge(message[2])
+            else:
+                print(message[1], file=sys.stderr)
+    finally:
+        for process in processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+
+def start_sweep(host, ranges, timeout, interval, window, bpf=False,
+                output=None, stages=None, mode=None, ring=False, workers=1):
+    """
+    Sweeps CIDR network and port ranges, streaming report is written
+    as answers arrive. MODE_CONNECT sweeps with connect(), any other
+    mode with raw socket (replies are read from PacketRing with ring).
+    With workers > 1 targets are sharded across that many processes.
+    """
+    stat = Stat()
+    writer = TableWriter(sweep=True) if output is None else output
+
+    for arg in [timeout, interval, window, workers]:
+        is_positive_num(arg)
+    validate_ports(ranges)
+
+    args = (host, ranges, timeout, interval, window, bpf)
+    try:
+        if workers > 1:
+            sharded_sweep(args, {'mode': mode, 'ring': ring}, workers, stat,
+                          writer, stages)
+        else:
+            for result in sweep_results(*args, stages, mode, ring):
+                record_probe(result, stat, writer)
+    finally:
+        writer.summary(stat)
+    return stat
 
 
 def parse_args(args):
@@ -336,13 +2988,13 @@ def parse_args(args):
     parser.add_argument(
         'host',
         type=str,
-        help='Host which you\'d like to ping')
+        help='Host (or CIDR network to sweep) which you\'d like to ping')
     parser.add_argument(
         '-p',
         '--port',
-        type=int,
+        type=parse_ports,
         default=80,
-        help='Target port')
+        help='Target port or list of ports to sweep, e.g. 22,80,8000-8100')
     parser.add_argument('-t', '--timeout',
                         type=float, default=0.5, help='Timeout (in seconds)')
     parser.add_argument(
@@ -353,20 +3005,133 @@ def parse_args(args):
         help='Number of connections counts (default = infinity)')
     parser.add_argument('-i', '--interval', type=float,
                         default=1, help='Interval between connections')
+    parser.add_argument(
+        '-w',
+        '--window',
+        type=int,
+        default=1,
+        help='Max number of probes in flight (default = 1, stop-and-wait)')
+    parser.add_argument(
+        '--bpf',
+        action='store_true',
+        help='Attach kernel BPF filter, so only our replies reach tcping')
+    parser.add_argument(
+        '--timestamps',
+        action='store_true',
+        help='Measure RTT with kernel receive timestamps (SO_TIMESTAMPNS)')
+    parser.add_argument(
+        '--pps',
+        type=float,
+        default=0,
+        help='Max packets per second for whole process (default = no limit)')
+    parser.add_argument(
+        '--burst',
+        type=int,
+        default=1,
+        help='Number of packets which may be sent at once under --pps')
+    parser.add_argument(
+        '--jitter',
+        type=float,
+        default=0,
+        help='Random extra delay under --pps, as a fraction of 1 / pps')
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=list(WRITERS),
+        default='table',
+        help='Output format (default = table)')
+    parser.add_argument(
+        '-m',
+        '--mode',
+        choices=MODES,
+        help='Probe with raw socket, connect() (no root needed) or scapy ' +
+             '(default = raw with root on Linux, scapy with root ' +
+             'elsewhere, connect otherwise)')
+    parser.add_argument(
+        '--race',
+        action='store_true',
+        help='Probe every IPv4 and IPv6 address of host at once and ' +
+             'report the fastest one')
+    parser.add_argument(
+        '--ring',
+        action='store_true',
+        help='Read sweep replies from memory-mapped AF_PACKET ring ' +
+             '(TPACKET_V3) instead of raw socket')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of processes to shard sweep targets across ' +
+             '(default = 1)')
+    parser.add_argument(
+        '--debug-stats',
+        action='store_true',
+        help='Print per-stage counters and sampled timers of hot path ' +
+             'to stderr')
 
     return parser.parse_args(args)
 
 
-def main(host, port, count, timeout, interval):
+def main(host, port, count, timeout, interval, window=1, bpf=False,
+         timestamps=False, pps=0, burst=1, jitter=0, output_format='table',
+         debug_stats=False, mode=None, race=False, ring=False, workers=1):
     """
     Tcping tool allows you to ping hosts by sending SYN TCP packet and
     recieving ACK TCP packet from other side.
     So, it doesn't need to establish TCP connection for pinging.
+    CIDR network or list of ports turns it into a single-socket sweep,
+    race probes all IPv4 and IPv6 addresses of host at once.
+    Sweep targets are sharded across workers processes.
+    """
+    pacer.configure(pps, burst, jitter)
+    is_sweep = '/' in host or isinstance(port, list)
+    if race and is_sweep:
+        print('--race probes all addresses of single host and port, ' +
+              'it can\'t sweep network or list of ports')
+        sys.exit(2)
+
+    if output_format == 'table':
+        output = TableWriter(sweep=is_sweep)
+    else:
+        output = WRITERS[output_format]()
+
+    stages = StageStats() if debug_stats else None
+    try:
+        if race:
+            start_race(host, port, count, timeout, interval, output)
+        elif is_sweep:
+            ranges = port if isinstance(port, list) else [(port, port)]
+            start_sweep(host, ranges, timeout, interval, window, bpf, output,
+                        stages, mode, ring, workers)
+        else:
+            for arg in [port, count, timeout, interval, window]:
+                is_positive_num(arg)
+            validate_port(port)
+
+            session = Session(host, port, count, timeout, interval, window,
+                              bpf, timestamps, output, WD_MODE, debug_stats,
+                              mode)
+            stages = session.stages
+            run_session(session)
+    except KeyboardInterrupt:
+        pass
+
+    if pps and output_format == 'table':
+        pacer.print()
+    if stages is not None:
+        stages.print()
+
+
+def cli(argv=None):
+    """
+    Console entry point of tcping package.
     """
-    start_tcping_session(host, port, count, timeout, interval, WD_MODE)
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    main(args.host, args.port, args.count, args.timeout, args.interval,
+         args.window, args.bpf, args.timestamps, args.pps, args.burst,
+         args.jitter, args.format, args.debug_stats, args.mode, args.race,
+         args.ring, args.workers)
 
 
 if __name__ == '__main__':
-    signal.signal(signal.SIGINT, sigint_handler)
-    args = parse_args(sys.argv[1:])
-    main(args.host, args.port, args.count, args.timeout, args.interval)
+    cli()
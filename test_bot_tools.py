@@ -0,0 +1,297 @@
+import collections
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+from time import sleep
+
+import bot_tools
+import tcping
+
+
+class TestRttHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.history = bot_tools.RttHistory(self.directory.name, raw_slots=8)
+        self.now = 1700006399
+        for i in range(7200):
+            if i % 10:
+                self.history.add('example.com', 80, 1000 + i % 100,
+                                 tcping.PORT_OPEN, self.now - 7199 + i)
+            else:
+                self.history.add('example.com', 80, None,
+                                 tcping.PORT_FILTERED, self.now - 7199 + i)
+
+    def tearDown(self):
+        self.history.close()
+        self.directory.cleanup()
+
+    def test_rollups(self):
+        buckets = self.history.rollups('example.com', 80, 3600, 12, self.now)
+        self.assertEqual(12, len(buckets))
+        self.assertEqual(self.now - 3599, buckets[0][0])
+        for start, probes, opened, rtt_min, rtt_max, rtt_sum in buckets:
+            self.assertEqual(300, probes)
+            self.assertEqual(270, opened)
+            self.assertEqual((1001, 1099), (rtt_min, rtt_max))
+
+        buckets = self.history.rollups('example.com', 80, 7 * 86400, 7,
+                                       self.now)
+        self.assertEqual(7200, sum(bucket[1] for bucket in buckets))
+        self.assertEqual(6480, sum(bucket[2] for bucket in buckets))
+        self.assertIsNone(self.history.rollups('example.org', 80, 60))
+        self.assertIsNone(self.history.rollups('example.com', 443, 60))
+
+    def test_persistence(self):
+        self.history.close()
+        history = bot_tools.RttHistory(self.directory.name, raw_slots=100)
+        ring = history.ring('example.com', 80)
+
+        self.assertEqual(8, ring.raw_slots)
+        self.assertEqual(7200, ring.added)
+        self.assertEqual([(self.now - 1.0, 1098, tcping.PORT_OPEN),
+                          (self.now, 1099, tcping.PORT_OPEN)],
+                         ring.samples()[-2:])
+        self.assertEqual(8, len(ring.samples()))
+        self.assertEqual(
+            self.history.rollups('example.com', 80, 600, now=self.now),
+            history.rollups('example.com', 80, 600, now=self.now))
+        self.history = history
+
+    def test_report(self):
+        report = self.history.report('example.com', 80, 3600, 6, self.now)
+        lines = report.split('\n')
+        self.assertEqual(7, len(lines))
+        self.assertIn('example.com:80: 3600 probes, 10.0% loss', lines[0])
+        self.assertIn('1.001ms/1.050ms/1.099ms', lines[0])
+        self.assertIsNone(self.history.report('example.org', 80, 3600))
+        self.assertEqual(604800, bot_tools.parse_duration('1w'))
+        self.assertEqual(1800, bot_tools.parse_duration('30m'))
+        for text in ['', 'm', '0h', '5y', '-1d']:
+            with self.assertRaises(ValueError):
+                bot_tools.parse_duration(text)
+
+    def test_ports(self):
+        self.history.add('example.com', 443, 1000, tcping.PORT_OPEN)
+        self.history.add('example.com.au', 80, 1000, tcping.PORT_OPEN)
+        self.history.add('::1', 53, None, tcping.PORT_FILTERED)
+
+        self.assertEqual([80, 443], self.history.ports('example.com'))
+        self.assertEqual([53], self.history.ports('::1'))
+        self.assertEqual([], self.history.ports('example.org'))
+
+    def test_max_open(self):
+        history = bot_tools.RttHistory(self.directory.name, max_open=2,
+                                       raw_slots=8)
+        self.addCleanup(history.close)
+        for port in range(1, 5):
+            history.add('example.org', port, 1000 * port, tcping.PORT_OPEN,
+                        self.now)
+
+        self.assertEqual([('example.org', 3), ('example.org', 4)],
+                         list(history.rings))
+        buckets = history.rollups('example.org', 1, 60, 1, self.now)
+        self.assertEqual([(self.now // 60 * 60, 1, 1, 1000, 1000, 1000)],
+                         buckets)
+        self.assertEqual([('example.org', 4), ('example.org', 1)],
+                         list(history.rings))
+
+    def test_parse_target(self):
+        self.assertEqual(('habr.ru', None), bot_tools.parse_target('habr.ru'))
+        self.assertEqual(('habr.ru', 443),
+                         bot_tools.parse_target('habr.ru:443'))
+        self.assertEqual(('::1', None), bot_tools.parse_target('::1'))
+        self.assertEqual(('::1', 53), bot_tools.parse_target('[::1]:53'))
+
+
+class FakeApiError(Exception):
+
+    def __init__(self, retry_after=None):
+        super().__init__('Too Many Requests')
+        self.result_json = {'ok': False, 'error_code': 429}
+        if retry_after is not None:
+            self.result_json['parameters'] = {'retry_after': retry_after}
+
+
+class FakeBot:
+    """
+    Local stand-in of Telegram bot: records sent messages, may be slow
+    and fail first send attempts.
+    """
+
+    def __init__(self, delay=0, errors=()):
+        self.delay = delay
+        self.errors = list(errors)
+        self.messages = []
+        self.attempts = []
+
+    def send_message(self, chat_id, text):
+        self.attempts.append(time.monotonic())
+        sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        self.messages.append((chat_id, text))
+
+
+class TestNotifier(unittest.TestCase):
+
+    def test_coalesces(self):
+        bot = FakeBot()
+        notifier = bot_tools.Notifier(bot.send_message, 0.1, 0)
+        notifier.start()
+        lines = [f'Host: 10.0.{i // 256}.{i % 256} is offline now'
+                 for i in range(200)]
+        for line in lines:
+            notifier.notify(1, line)
+        notifier.notify(2, 'Host: 10.1.0.1 is online now')
+        sleep(0.3)
+
+        self.assertEqual(3, len(bot.messages))
+        self.assertEqual(lines, '\n'.join(
+            text for chat_id, text in bot.messages if chat_id == 1
+        ).split('\n'))
+        self.assertTrue(all(len(text) <= bot_tools.Notifier.max_length
+                            for _, text in bot.messages))
+        notifier.stop()
+        self.assertEqual((201, 3), (notifier.queued, notifier.sent))
+
+    def test_never_blocks(self):
+        bot = FakeBot(delay=0.2)
+        notifier = bot_tools.Notifier(bot.send_message, 0, 0)
+        notifier.start()
+
+        init_time = time.monotonic()
+        for i in range(5):
+            notifier.notify(1, f'Host: 10.0.0.{i} is offline now')
+            sleep(0.01)
+        self.assertLess(time.monotonic() - init_time, 0.15)
+
+        notifier.stop()
+        self.assertEqual(2, len(bot.messages))
+        self.assertEqual(5, sum(text.count('\n') + 1
+                                for _, text in bot.messages))
+
+    def test_rate_limit_and_backoff(self):
+        bot = FakeBot(errors=[FakeApiError(0.1), FakeApiError()])
+        notifier = bot_tools.Notifier(bot.send_message, 0, 0.05)
+        notifier.start()
+        notifier.notify(1, 'first')
+        sleep(0.3)
+        notifier.notify(1, 'second')
+        notifier.stop()
+
+        self.assertEqual([(1, 'first'), (1, 'second')], bot.messages)
+        self.assertEqual(2, notifier.errors)
+        gaps = [b - a for a, b in zip(bot.attempts, bot.attempts[1:])]
+        self.assertGreaterEqual(gaps[0], 0.1)
+        self.assertGreaterEqual(gaps[1], 0.05)
+        self.assertGreaterEqual(gaps[2], 0.05)
+
+    def test_drops_after_retries(self):
+        bot = FakeBot(errors=[FakeApiError(0.01)] * 3)
+        notifier = bot_tools.Notifier(bot.send_message, 0, 0, max_retries=2)
+        notifier.start()
+        notifier.notify(1, 'lost')
+        notifier.stop(1)
+
+        self.assertEqual([], bot.messages)
+        self.assertEqual((3, 1), (notifier.errors, notifier.dropped))
+        self.assertIsNone(bot_tools.retry_after(ValueError()))
+
+
+class TestSessionPool(unittest.TestCase):
+
+    def setUp(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(128)
+        self.open_port = listener.getsockname()[1]
+
+    def test_session_pool(self):
+        pool = bot_tools.SessionPool(workers=2, max_jobs=3,
+                                     progress_interval=0.05)
+        progress = collections.defaultdict(list)
+        jobs = [pool.submit('127.0.0.1', self.open_port, 5, 0.5, 0.05,
+                            lambda job: progress[job.id].append(
+                                job.describe()))
+                for _ in range(3)]
+
+        self.assertIsNone(pool.submit('127.0.0.1', self.open_port, 5, 0.5,
+                                      0.05))
+        self.assertEqual([1, 2, 3], [job.id for job in jobs])
+        self.assertTrue(pool.cancel(3))
+        for job in jobs[:2]:
+            self.assertIsNone(job.future.exception(5))
+        pool.shutdown()
+
+        for job in jobs[:2]:
+            self.assertEqual(bot_tools.JOB_DONE, job.state)
+            self.assertEqual(5, job.log.getvalue().count('OK! Got response'))
+            self.assertIn(f'Job #{job.id} 127.0.0.1:{self.open_port} ' +
+                          'running', progress[job.id][0])
+            self.assertIn('done: 5/5 probes, 5 open, min/avg/max',
+                          progress[job.id][-1])
+            self.assertGreater(len(progress[job.id]), 2)
+        self.assertEqual(bot_tools.JOB_CANCELLED, jobs[2].state)
+        self.assertEqual([], pool.active())
+        self.assertFalse(pool.cancel(1))
+
+    def test_slow_progress(self):
+        pool = bot_tools.SessionPool(workers=2, progress_interval=0.01)
+        progress = []
+
+        def slow_progress(job):
+            progress.append(job.state)
+            sleep(0.3)
+
+        init_time = time.monotonic()
+        job = pool.submit('127.0.0.1', self.open_port, 10, 0.5, 0.02,
+                          slow_progress)
+        job.future.result(2)
+        # probing doesn't wait for progress updates
+        self.assertLess(time.monotonic() - init_time, 0.6)
+        self.assertEqual(10, job.session.stat.recv)
+        pool.shutdown()
+
+        self.assertEqual(bot_tools.JOB_RUNNING, progress[0])
+        self.assertEqual(bot_tools.JOB_DONE, progress[-1])
+        self.assertEqual(1, progress.count(bot_tools.JOB_DONE))
+
+    def test_session_pool_cancel(self):
+        pool = bot_tools.SessionPool(workers=2)
+        running = pool.submit('127.0.0.1', self.open_port, 1000, 0.5, 0.05)
+        failed = pool.submit('127.0.0.1', 0, 5, 0.5, 0.05)
+        sleep(0.2)
+
+        init_time = time.monotonic()
+        self.assertTrue(running.cancel())
+        running.future.result(2)
+        self.assertLess(time.monotonic() - init_time, 0.5)
+        self.assertEqual(bot_tools.JOB_CANCELLED, running.state)
+        self.assertLess(running.session.stat.send, 10)
+
+        failed.future.result(2)
+        self.assertEqual(bot_tools.JOB_FAILED, failed.state)
+        self.assertIn('positive numbers', failed.describe())
+        pool.shutdown()
+
+    def test_session_pool_errors(self):
+        pool = bot_tools.SessionPool(workers=2)
+        unknown = pool.submit('host.invalid', self.open_port, 5, 0.5, 0.05)
+        error = PermissionError(1, 'Operation not permitted')
+        with mock.patch.object(tcping, 'open_raw_socket', side_effect=error):
+            denied = pool.submit('127.0.0.1', self.open_port, 5, 0.5, 0.05)
+            denied.future.result(2)
+        unknown.future.result(5)
+        pool.shutdown()
+
+        self.assertEqual(bot_tools.JOB_FAILED, unknown.state)
+        self.assertEqual(bot_tools.JOB_FAILED, denied.state)
+        self.assertIn('Operation not permitted', denied.describe())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,24 @@
+import asyncio
+import contextlib
+import csv
+import errno
+import io
+import itertools
+import json
+import math
 import os
+import random
 import socket
+import struct
+import subprocess
 import unittest
+from unittest import mock
 import tcping
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
 
 
 class TestTCPing(unittest.TestCase):
@@ -11,7 +27,8 @@ class TestTCPing(unittest.TestCase):
         stat = tcping.Stat()
         stat.send = 10
         stat.recv = 5
-        stat.time_deltas = [10, 20, 30, 40, 50]
+        for delta in [10, 20, 30, 40, 50]:
+            stat.add_delta(delta)
 
         self.assertAlmostEqual(150 / 5, stat.get_avg_time())
         self.assertAlmostEqual(50, stat.get_packet_loss())
@@ -27,6 +44,42 @@ class TestTCPing(unittest.TestCase):
         self.assertEqual(-1, stat.min_delta())
         self.assertEqual(-1, stat.max_delta())
         self.assertEqual(-1, stat.get_avg_time())
+        self.assertEqual(-1, stat.get_percentile(50))
+        self.assertEqual(-1, stat.get_jitter())
+
+    def test_stream_stats(self):
+        stat = tcping.Stat()
+        deltas = [random.randint(1, 5000) for _ in range(10000)]
+        for delta in deltas:
+            stat.add_delta(delta)
+
+        deltas.sort()
+        self.assertEqual(deltas[0], stat.min_delta())
+        self.assertEqual(deltas[-1], stat.max_delta())
+        self.assertEqual(round(sum(deltas) / len(deltas)), stat.get_avg_time())
+
+        for percent in [50, 90, 99]:
+            expected = deltas[math.ceil(len(deltas) * percent / 100) - 1]
+            real = stat.get_percentile(percent)
+            self.assertLessEqual(abs(real - expected), expected / 64)
+
+        mean = sum(deltas) / len(deltas)
+        jitter = math.sqrt(sum((d - mean) ** 2 for d in deltas) / len(deltas))
+        self.assertAlmostEqual(jitter, stat.get_jitter(), delta=1)
+
+    def test_merge_stats(self):
+        fst, sec, both = tcping.Stat(), tcping.Stat(), tcping.Stat()
+        for delta in range(1, 300):
+            (fst if delta % 3 else sec).add_delta(delta)
+            both.add_delta(delta)
+
+        fst.merge(sec)
+        self.assertEqual(both.count, fst.count)
+        self.assertEqual(both.get_avg_time(), fst.get_avg_time())
+        self.assertEqual(both.get_jitter(), fst.get_jitter())
+        self.assertEqual(1, fst.min_delta())
+        self.assertEqual(299, fst.max_delta())
+        self.assertEqual(list(both.hist.counts), list(fst.hist.counts))
 
     def test_dst_ip(self):
         expected = '77.88.8.8'
@@ -51,6 +104,147 @@ class TestTCPing(unittest.TestCase):
 
         self.assertEqual(expected, real)
 
+    def test_syn_template(self):
+        template = tcping.SynTemplate('172.22.90.211', 49155,
+                                      '178.248.233.33', 80)
+        for seq_num in [0, 420, 65535, 65536, 1234567, 0xffffffff] + \
+                [random.randint(0, 0xffffffff) for _ in range(1000)]:
+            expected = tcping.form_packet(
+                '172.22.90.211', 49155, '178.248.233.33', 80, seq_num, 2)
+            self.assertEqual(expected, bytes(template.packet(seq_num)))
+
+    def test_format_time(self):
+        self.assertEqual('-1ms', tcping.format_time(-1))
+        self.assertEqual('0.042ms', tcping.format_time(42))
+        self.assertEqual('1234.567ms', tcping.format_time(1234567))
+
+    def test_host_states(self):
+        states = tcping.HostStates()
+        self.assertEqual([], states.wait_transitions(0.01))
+
+        publisher = threading.Timer(0.05, states.publish,
+                                    (('a.test', 80), True))
+        publisher.start()
+        init_time = time.monotonic()
+        transitions = states.wait_transitions(5)
+        self.assertLess(time.monotonic() - init_time, 1)
+        self.assertEqual([(('a.test', 80), None, True)], transitions)
+
+        for _ in range(3):
+            states.publish(('a.test', 80), True)
+            states.publish(('a.test', 22), False)
+        states.publish(('a.test', 80), False)
+        self.assertEqual([(('a.test', 22), None, False),
+                          (('a.test', 80), True, False)],
+                         states.wait_transitions(0))
+        self.assertFalse(states.get(('a.test', 80)))
+
+    def test_writers(self):
+        results = [
+            tcping.ProbeResult('a.test', '10.0.0.1', 80, 1, 1500,
+                               timestamp=1.5),
+            tcping.ProbeResult('a.test', '10.0.0.1', 80, 2, None,
+                               timestamp=2.5),
+        ]
+        stat = tcping.Stat()
+        stat.send, stat.recv = 2, 1
+        stat.add_delta(1500)
+
+        out = io.StringIO()
+        writer = tcping.JsonLinesWriter(out, batch=10)
+        for res in results:
+            writer.write(res)
+        self.assertEqual('', out.getvalue())
+        writer.summary(stat)
+
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(['probe', 'probe', 'summary'],
+                         [rec['type'] for rec in records])
+        self.assertEqual(1500, records[0]['rtt_us'])
+        self.assertEqual('filtered', records[1]['state'])
+        self.assertEqual(50, records[2]['loss_percent'])
+
+        out = io.StringIO()
+        writer = tcping.CsvWriter(out)
+        for res in results:
+            writer.write(res)
+        writer.summary(stat)
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(['1500', ''], [row['rtt_us'] for row in rows])
+        self.assertEqual(['open', 'filtered'], [row['state'] for row in rows])
+
+        out = io.StringIO()
+        writer = tcping.TableWriter(out)
+        writer.write(results[0])
+        self.assertEqual('OK! Got response from 10.0.0.1:[80] : seq = 1, ' +
+                         'time = 1.500ms\n', out.getvalue())
+
+    def test_memory_writer(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(16)
+        port = listener.getsockname()[1]
+
+        writer = tcping.MemoryWriter()
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            tcping.start_tcping_session(
+                '127.0.0.1', port, 3, 0.5, 0.01, False, output=writer)
+        listener.close()
+
+        self.assertEqual('', out.getvalue())
+        self.assertEqual(3, len(writer.results))
+        self.assertTrue(all(res.ok for res in writer.results))
+        self.assertEqual(3, writer.stat.recv)
+
+    def test_lazy_imports(self):
+        out = subprocess.run(
+            [sys.executable, '-c', 'import sys, tcping; ' +
+             'print(sorted({"scapy", "texttable", "asyncio"} & ' +
+             'set(sys.modules)))'],
+            capture_output=True, text=True, check=True)
+        self.assertEqual('[]', out.stdout.strip())
+
+    def test_unpack_icmp(self):
+        syn = bytes([0x45]) + bytes(8) + bytes([socket.IPPROTO_TCP]) + \
+            bytes(2) + socket.inet_aton('10.0.0.2') + \
+            socket.inet_aton('10.0.0.1') + \
+            tcping.form_packet('10.0.0.2', 50000, '10.0.0.1', 80, 1234, 2)
+        outer = bytes([0x45]) + bytes(19)
+
+        def icmp(kind, code):
+            return outer + bytes([kind, code]) + bytes(6) + syn[:28]
+
+        self.assertEqual(
+            (50000, '10.0.0.1', 80, 1234, tcping.PORT_UNREACHABLE),
+            tcping.unpack_icmp(icmp(3, 1)))
+        self.assertEqual(tcping.PORT_FILTERED,
+                         tcping.unpack_icmp(icmp(3, 13))[-1])
+        self.assertIsNone(tcping.unpack_icmp(icmp(0, 0)))
+        self.assertEqual(tcping.PORT_OPEN, tcping.tcp_state(0x12))
+        self.assertEqual(tcping.PORT_CLOSED, tcping.tcp_state(0x14))
+        self.assertIsNone(tcping.tcp_state(0x10))
+
+    def test_unpack_reply_ip_options(self):
+        tcp = struct.pack('!HHIIBB', 80, 50000, 7, 1235, 80, 0x12)
+        for header in [bytes([0x45]) + bytes(11),
+                       bytes([0x46]) + bytes(11) + bytes(4)]:
+            packet = bytearray(header[:12] + socket.inet_aton('10.0.0.1') +
+                               bytes(4) + header[12:] + tcp)
+            self.assertEqual(('10.0.0.1', 80, 1235, 0x12),
+                             tcping.unpack_reply(memoryview(packet)))
+
+    def test_ipv6_checksum(self):
+        packet = tcping.form_packet('fd00::2', 50000, '2a02:6b8::feed:ff',
+                                    80, 1234, 2)
+        pshdr = socket.inet_pton(socket.AF_INET6, 'fd00::2') + \
+            socket.inet_pton(socket.AF_INET6, '2a02:6b8::feed:ff') + \
+            struct.pack('!I3xB', len(packet), socket.IPPROTO_TCP)
+        self.assertEqual(0, tcping.get_checksum(pshdr + packet))
+
+        template = tcping.SynTemplate('fd00::2', 50000, '2a02:6b8::feed:ff',
+                                      80)
+        self.assertEqual(packet, bytes(template.packet(1234)))
+
     def test_new_socket(self):
         timeout = 2
         soc = tcping.new_socket(timeout)
@@ -62,6 +256,41 @@ class TestTCPing(unittest.TestCase):
         self.assertEqual(args.host, '1.1.1.1')
         self.assertEqual(args.port, 53)
 
+    def test_parse_ports(self):
+        args = tcping.parse_args(['10.0.0.0/16', '-p', '22,80,8000-8100'])
+        self.assertEqual([(22, 22), (80, 80), (8000, 8100)], args.port)
+        self.assertEqual(443, tcping.parse_ports('443'))
+        with self.assertRaises(SystemExit):
+            tcping.parse_args(['10.0.0.0/16', '-p', '22,http'])
+
+    def test_iter_targets(self):
+        targets = tcping.iter_targets('10.0.0.0/8', [(22, 22), (80, 81)])
+        self.assertEqual([('10.0.0.1', 22), ('10.0.0.2', 22)],
+                         list(itertools.islice(targets, 2)))
+
+        targets = list(tcping.iter_targets('10.0.0.0/30', [(80, 81)]))
+        self.assertEqual([('10.0.0.1', 80), ('10.0.0.2', 80),
+                          ('10.0.0.1', 81), ('10.0.0.2', 81)], targets)
+
+    def test_sweep_scheduler(self):
+        scheduler = tcping.SweepScheduler(range(5), 1, 0, 2)
+        now = time.monotonic()
+        for target in scheduler.due(now):
+            scheduler.add(target, target, now)
+        self.assertEqual({0: 0, 1: 1}, scheduler.pending)
+        self.assertEqual(0, scheduler.pop(0))
+
+        for target in scheduler.due(now + 0.5):
+            scheduler.add(target, target, now + 0.5)
+        self.assertEqual([(1, 1)], list(scheduler.expired(now + 1)))
+        self.assertEqual([2], list(scheduler.pending))
+        self.assertFalse(scheduler.done())
+
+        scheduler = tcping.SweepScheduler(range(5), 1, 0.1, 5)
+        now = time.monotonic()
+        self.assertEqual([0], list(scheduler.due(now)))
+        self.assertAlmostEqual(0.1, scheduler.wait_time(now), 2)
+
     def test_is_positive_num(self):
         with self.assertRaises(SystemExit) as cm:
             tcping.is_positive_num(-512),
@@ -72,6 +301,13 @@ class TestTCPing(unittest.TestCase):
             tcping.validate_port(65539),
         self.assertEqual(cm.exception.code, 3)
 
+    def test_check_probe_args(self):
+        tcping.check_probe_args(65535, 1, 0.5, 0.5)
+        for args in [(0, 1, 1, 1), (65536, 1, 1, 1), (80, 1, -1, 1),
+                     (80, 1, 1, 1, 0)]:
+            with self.assertRaises(ValueError):
+                tcping.check_probe_args(*args)
+
     def test_get_checksum(self):
         pshdr = b'\xac\x1d\xd2\xac\xb2\xf8\xe9!\x00\x06\x00\x14'
 
@@ -90,11 +326,11 @@ class TestTCPing(unittest.TestCase):
                 """Unable to get a response from target host: 77.88.8.8:[50]
 
 
-+------+------+------+------+----------+-------------+
-| Avg  | Min  | Max  | Sent | Recieved | Packet loss |
-+======+======+======+======+==========+=============+
-| -1ms | -1ms | -1ms | 1    | 0        | 100%        |
-+------+------+------+------+----------+-------------+""")
++------+------+------+------+------+------+--------+------+----------+-------------+
+| Avg  | Min  | Max  | P50  | P90  | P99  | Jitter | Sent | Recieved | Packet loss |
++======+======+======+======+======+======+========+======+==========+=============+
+| -1ms | -1ms | -1ms | -1ms | -1ms | -1ms | -1ms   | 1    | 0        | 100%        |
++------+------+------+------+------+------+--------+------+----------+-------------+""")
 
         with open("expected_output.txt", 'rb') as exp_out:
             exp_lines = exp_out.read()
@@ -123,5 +359,716 @@ class TestTCPing(unittest.TestCase):
         real = tcping.get_src_ip()
         self.assertEqual(expected, real)
 
+
+class TestResolverCache(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.answers = {'a.test': ('10.0.0.1', None)}
+        self.release = threading.Event()
+        self.release.set()
+
+    def lookup(self, host):
+        self.calls.append(host)
+        self.release.wait(5)
+        if host not in self.answers:
+            raise socket.gaierror('unknown host')
+        return self.answers[host]
+
+    def test_cache_hit(self):
+        cache = tcping.ResolverCache(ttl=60, lookup=self.lookup)
+        for _ in range(1000):
+            self.assertEqual('10.0.0.1', cache.resolve('a.test'))
+        self.assertEqual(['a.test'], self.calls)
+
+    def test_concurrent_lookups(self):
+        cache = tcping.ResolverCache(ttl=60, lookup=self.lookup)
+        self.release.clear()
+
+        with ThreadPoolExecutor(10) as pool:
+            futures = [pool.submit(cache.resolve, 'a.test')
+                       for _ in range(10)]
+            sleep(0.1)
+            self.release.set()
+            self.assertEqual(['10.0.0.1'] * 10,
+                             [future.result() for future in futures])
+        self.assertEqual(['a.test'], self.calls)
+
+    def test_negative_cache(self):
+        cache = tcping.ResolverCache(negative_ttl=60, lookup=self.lookup)
+        for _ in range(3):
+            with self.assertRaises(socket.gaierror):
+                cache.resolve('b.test')
+        self.assertEqual(['b.test'], self.calls)
+
+    def test_background_refresh(self):
+        cache = tcping.ResolverCache(lookup=self.lookup)
+        self.answers['a.test'] = ('10.0.0.1', 0.1)
+        self.assertEqual('10.0.0.1', cache.resolve('a.test'))
+
+        sleep(0.15)
+        self.answers['a.test'] = ('10.0.0.2', 60)
+        self.release.clear()
+        self.assertEqual('10.0.0.1', cache.resolve('a.test'))
+        self.release.set()
+
+        sleep(0.1)
+        self.assertEqual('10.0.0.2', cache.resolve('a.test'))
+        self.assertEqual(2, len(self.calls))
+
+    def test_keeps_address_on_failure(self):
+        cache = tcping.ResolverCache(lookup=self.lookup)
+        self.answers['a.test'] = ('10.0.0.1', 0.05)
+        cache.resolve('a.test')
+
+        sleep(0.1)
+        del self.answers['a.test']
+        self.assertEqual('10.0.0.1', cache.resolve('a.test'))
+        sleep(0.1)
+        self.assertEqual('10.0.0.1', cache.resolve('a.test'))
+
+    def test_invalid_name(self):
+        cache = tcping.ResolverCache(negative_ttl=0)
+        for _ in range(2):
+            with self.assertRaises(socket.gaierror):
+                cache.resolve('a..b')
+        self.assertEqual({}, cache.in_flight)
+
+        cache = tcping.ResolverCache(lookup=lambda host: 1 / 0)
+        with self.assertRaises(socket.gaierror):
+            cache.resolve('a.test')
+        self.assertEqual({}, cache.in_flight)
+
+    def test_non_blocking_miss(self):
+        cache = tcping.ResolverCache(lookup=self.lookup)
+        self.release.clear()
+        self.assertIsNone(cache.resolve('a.test', block=False))
+        self.release.set()
+        self.assertEqual('10.0.0.1', cache.resolve('a.test'))
+        self.assertEqual(['a.test'], self.calls)
+
+
+class TestPacer(unittest.TestCase):
+
+    def test_unlimited(self):
+        pacer = tcping.Pacer()
+        self.assertEqual([0] * 100, [pacer.reserve() for _ in range(100)])
+        self.assertEqual(100, pacer.acquired)
+        self.assertEqual(0, pacer.delayed)
+
+    def test_spreads_evenly(self):
+        pacer = tcping.Pacer(pps=100, burst=5)
+        delays = [pacer.reserve() for _ in range(15)]
+
+        self.assertEqual([0] * 5, delays[:5])
+        for i, delay in enumerate(delays[5:]):
+            self.assertAlmostEqual((i + 1) / 100, delay, delta=0.005)
+        self.assertEqual(10, pacer.delayed)
+        self.assertAlmostEqual(0.55, pacer.wait_time, delta=0.05)
+        self.assertAlmostEqual(0.1, pacer.max_wait, delta=0.005)
+
+    def test_jitter(self):
+        pacer = tcping.Pacer(pps=1000, jitter=1)
+        pacer.reserve()
+        delays = [pacer.reserve() for _ in range(100)]
+        for i, delay in enumerate(delays):
+            # reservations are relative to now, which moves meanwhile
+            self.assertGreaterEqual(delay, (i + 1) / 1000 - 0.005)
+            self.assertLessEqual(delay, (i + 2) / 1000)
+
+    def test_acquire(self):
+        pacer = tcping.Pacer(pps=200)
+        init_time = time.monotonic()
+        for _ in range(21):
+            pacer.acquire()
+        self.assertAlmostEqual(0.1, time.monotonic() - init_time, delta=0.05)
+
+
+class LoopbackTestCase(unittest.TestCase):
+    """
+    Base of tests probing loopback ports. Sockets made by the helpers
+    are closed on cleanup.
+    """
+
+    def listen(self, host='127.0.0.1', backlog=128):
+        """
+        Returns port of listener, kernel answers SYNs with SYN-ACK.
+        """
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind((host, 0))
+        listener.listen(backlog)
+        return listener.getsockname()[1]
+
+    def closed_port(self, host='127.0.0.1'):
+        """
+        Returns port bound without listen, kernel answers SYNs with RST.
+        """
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        closed = socket.socket(family, socket.SOCK_STREAM)
+        self.addCleanup(closed.close)
+        closed.bind((host, 0))
+        return closed.getsockname()[1]
+
+    def silent_port(self):
+        """
+        Returns port of listener with full accept queue, kernel drops
+        SYNs sent to it without any answer.
+        """
+        port = self.listen(backlog=0)
+        for _ in range(3):
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.setblocking(False)
+            client.connect_ex(('127.0.0.1', port))
+            self.addCleanup(client.close)
+        sleep(0.05)
+        return port
+
+
+class TestProbeEngine(LoopbackTestCase):
+
+    def setUp(self):
+        self.open_port = self.listen()
+
+        self.engine = tcping.ProbeEngine(0.5)
+        self.results = {}
+        self.states = {}
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.engine.stop()
+        if self.engine.thread is not None:
+            self.engine.thread.join()
+        else:
+            self.engine.close()
+
+    def collect(self, target, seq_num, delta, state):
+        if state != tcping.PORT_OPEN:
+            delta = None
+        self.results.setdefault(target.port, []).append(delta)
+        self.states.setdefault(target.port, set()).add(state)
+        if all(len(res) >= 2 for res in self.results.values()) and \
+                len(self.results) == 2:
+            self.done.set()
+
+    def test_routes_replies_per_target(self):
+        closed_port = self.closed_port()
+
+        self.engine.add_target(
+            '127.0.0.1', self.open_port, 0.1, 0.2, self.collect)
+        self.engine.add_target(
+            '127.0.0.1', closed_port, 0.1, 0.2, self.collect)
+        self.engine.start()
+
+        self.assertTrue(self.done.wait(5))
+
+        self.assertTrue(all(
+            delta is not None for delta in self.results[self.open_port]))
+        self.assertTrue(all(
+            delta is None for delta in self.results[closed_port]))
+
+    def test_failing_callback(self):
+        def fail(target, seq_num, delta, state):
+            raise OSError(errno.EMFILE, 'Too many open files')
+
+        failing = self.engine.add_target(
+            '127.0.0.1', self.closed_port(), 0.01, 0.5, fail, count=2)
+        self.engine.add_target(
+            '127.0.0.1', self.open_port, 0.01, 0.5, self.collect, count=3)
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.engine.start()
+            self.assertTrue(failing.done.wait(5))
+            self.assertTrue(
+                self.engine.targets[('127.0.0.1', self.open_port)]
+                .done.wait(5))
+
+        self.assertEqual(3, len(self.results[self.open_port]))
+        self.assertEqual(2, self.engine.callback_errors)
+        self.assertIn('Too many open files', err.getvalue())
+
+    def test_follows_address_change(self):
+        port = self.listen('0.0.0.0')
+        addresses = {'watched.test': '127.0.0.1'}
+        cache = tcping.ResolverCache(
+            ttl=0.05, lookup=lambda host: (addresses[host], None))
+        self.addCleanup(cache.pool.shutdown)
+        seen = []
+
+        def collect(target, seq_num, delta, state):
+            seen.append((target.dst_ip, state))
+            if len(seen) == 5:
+                addresses['watched.test'] = '127.0.0.2'
+
+        with mock.patch.object(tcping, 'resolver', cache), \
+                mock.patch.object(tcping.ProbeTarget, 'resolve_interval',
+                                  0.01):
+            target = self.engine.add_target(
+                'watched.test', port, 0.02, 0.5, collect, count=25)
+            self.engine.start()
+            self.assertTrue(target.done.wait(5))
+
+        self.assertEqual(('127.0.0.1', tcping.PORT_OPEN), seen[0])
+        self.assertEqual(('127.0.0.2', tcping.PORT_OPEN), seen[-1])
+        self.assertEqual({tcping.PORT_OPEN}, {state for _, state in seen})
+
+    def test_invalid_target(self):
+        with self.assertRaises(ValueError):
+            self.engine.add_target(
+                '127.0.0.1', 70000, 0.01, 0.5, self.collect)
+        self.assertEqual({}, self.engine.targets)
+
+    def test_remove_target(self):
+        self.engine.add_target(
+            '127.0.0.1', self.open_port, 0.05, 0.2, self.collect)
+        self.engine.remove_target('127.0.0.1', self.open_port)
+        self.engine.start()
+
+        sleep(0.2)
+        self.assertEqual({}, self.results)
+        self.assertEqual({}, self.engine.targets)
+
+    def test_window_keeps_schedule(self):
+        closed_port = self.closed_port()
+
+        target = self.engine.add_target(
+            '127.0.0.1', closed_port, 0.01, 0.1, self.collect,
+            count=20, window=20)
+
+        init_time = time.monotonic()
+        self.engine.start()
+        self.assertTrue(target.done.wait(5))
+
+        self.assertLess(time.monotonic() - init_time, 1)
+        self.assertEqual(20, target.sent)
+        self.assertEqual([None] * 20, self.results[closed_port])
+
+    def test_window_limits_in_flight(self):
+        target = self.engine.add_target(
+            '127.0.0.1', self.silent_port(), 0.01, 0.3, self.collect,
+            count=10, window=2)
+        self.engine.start()
+
+        sleep(0.2)
+        self.assertEqual(2, target.sent)
+        self.assertTrue(target.done.wait(5))
+
+    def test_rst_finishes_probe(self):
+        closed_port = self.closed_port()
+        silent_port = self.silent_port()
+
+        self.engine.add_target(
+            '127.0.0.1', closed_port, 0.01, 5, self.collect, count=3)
+        self.engine.add_target(
+            '127.0.0.1', silent_port, 0.01, 0.1, self.collect, count=3)
+
+        init_time = time.monotonic()
+        self.engine.start()
+        self.assertTrue(self.done.wait(5))
+
+        self.assertLess(time.monotonic() - init_time, 1)
+        self.assertEqual({tcping.PORT_CLOSED}, self.states[closed_port])
+        self.assertEqual({tcping.PORT_FILTERED}, self.states[silent_port])
+
+        writer = tcping.MemoryWriter()
+        tcping.Session('127.0.0.1', closed_port, 2, 5, 0.01,
+                       output=writer).run()
+        self.assertEqual([tcping.PORT_CLOSED] * 2,
+                         [res.state for res in writer.results])
+        self.assertEqual(0, writer.stat.recv)
+
+    def test_bpf_filter(self):
+        program = tcping.build_bpf_filter(50000, '127.0.0.1')
+        self.assertEqual((tcping.BPF_RET_K, 0, 0, 0), program[-1])
+        self.assertEqual(11, len(program))
+
+        engine = tcping.ProbeEngine(0.5, bpf=True)
+        target = engine.add_target(
+            '127.0.0.1', self.open_port, 0.01, 0.5, self.collect, count=5)
+        engine.start()
+        self.assertTrue(target.done.wait(5))
+        engine.stop()
+        engine.thread.join()
+
+        self.assertEqual(5, len(self.results[self.open_port]))
+        self.assertNotIn(None, self.results[self.open_port])
+        self.assertEqual(0, engine.rejected)
+
+    def test_kernel_timestamps(self):
+        engine = tcping.ProbeEngine(0.5, timestamps=True)
+        target = engine.add_target(
+            '127.0.0.1', self.open_port, 0.01, 0.5, self.collect, count=5)
+        engine.start()
+        self.assertTrue(target.done.wait(5))
+        engine.stop()
+        engine.thread.join()
+
+        deltas = self.results[self.open_port]
+        self.assertEqual(5, len(deltas))
+        self.assertTrue(all(0 <= delta < 100000 for delta in deltas))
+
+    def test_ipv6_session(self):
+        writer = tcping.MemoryWriter()
+        stat = tcping.Session('::1', self.listen('::1'), 3, 0.5,
+                              0.01, output=writer).run()
+        self.assertEqual(3, stat.recv)
+        self.assertEqual({'::1'}, {res.dst_ip for res in writer.results})
+
+    def test_ipv6_target(self):
+        port = self.listen('::1')
+        stages = tcping.StageStats()
+        engine = tcping.ProbeEngine(0.5, stages=stages)
+        target = engine.add_target(
+            '::1', port, 0.01, 0.5, self.collect, count=3)
+        engine.start()
+        self.assertTrue(target.done.wait(5))
+        engine.stop()
+        engine.thread.join()
+
+        self.assertEqual({tcping.PORT_OPEN}, self.states[port])
+        self.assertEqual(3, stages.counters['matched'])
+        self.assertEqual(0, stages.counters['send_errors'])
+
+    def test_ipv6_pipelined_session(self):
+        stat = tcping.Session('::1', self.listen('::1'), 5, 0.5, 0.01, 4,
+                              output=tcping.MemoryWriter()).run()
+        self.assertEqual(5, stat.recv)
+
+    def test_engine_pacing(self):
+        bucket = tcping.Pacer(pps=50)
+        engine = tcping.ProbeEngine(0.5, bucket=bucket)
+        target = engine.add_target(
+            '127.0.0.1', self.open_port, 0.001, 0.5, self.collect, count=20)
+
+        init_time = time.monotonic()
+        engine.start()
+        self.assertTrue(target.done.wait(5))
+        engine.stop()
+        engine.thread.join()
+
+        # 20 probes at 50 pps can't take less than 19 / 50 seconds
+        self.assertGreater(time.monotonic() - init_time, 0.35)
+        self.assertEqual(20, bucket.acquired)
+        self.assertGreaterEqual(bucket.delayed, 15)
+        self.assertNotIn(None, self.results[self.open_port])
+
+    def test_pipelined_session(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            stat = tcping.start_tcping_session(
+                '127.0.0.1', self.open_port, 10, 0.5, 0.01, False, 4)
+
+        self.assertEqual(10, stat.send)
+        self.assertEqual(10, stat.recv)
+        self.assertEqual(10, out.getvalue().count('OK! Got response'))
+
+    def test_concurrent_sessions(self):
+        sessions = [
+            tcping.Session('127.0.0.1', self.open_port, 5 + i % 3, 0.5,
+                           0.01, window=1 + i % 2,
+                           output=tcping.MemoryWriter())
+            for i in range(20)
+        ]
+        threads = [threading.Thread(target=session.run) for session in sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        for session in sessions:
+            self.assertEqual(session.count, session.stat.send)
+            self.assertEqual(session.count, session.stat.recv)
+            self.assertEqual(session.count, len(session.writer.results))
+
+    def test_debug_stats(self):
+        for window in [1, 4]:
+            session = tcping.Session(
+                '127.0.0.1', self.open_port, 5, 0.5, 0.01, window,
+                output=tcping.MemoryWriter(), debug_stats=True)
+            # time every probe instead of a sample
+            session.stages = tcping.StageStats(sample_every=1)
+            session.run()
+
+            stages = session.stages
+            self.assertEqual(5, stages.calls['build'])
+            self.assertEqual(5, stages.calls['send'])
+            self.assertEqual(5, stages.counters['matched'])
+            self.assertEqual(0, stages.counters['timeouts'])
+            self.assertGreater(stages.time_ns['poll'], 0)
+            self.assertEqual(5, stages.as_dict()['send']['calls'])
+
+    def test_sampled_stats(self):
+        stages = tcping.StageStats(sample_every=8)
+        targets = [('127.0.0.1', self.open_port)] * 200
+        results = list(tcping.sweep(targets, 0.5, 0, 1, stages=stages))
+
+        # counters are exact, timers sampled and scaled
+        self.assertEqual(200, len(results))
+        self.assertEqual(200, stages.counters['matched'])
+        self.assertTrue(0 < stages.calls['send'] < 100)
+        self.assertEqual(8 * stages.time_ns['send'],
+                         stages.as_dict()['send']['estimated_ns'])
+        self.assertIn('Timed 1 of 8', stages.draw())
+
+    def test_timeout_under_icmp_noise(self):
+        port = self.silent_port()
+        pinger = socket.socket(
+            socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        self.addCleanup(pinger.close)
+        echo = bytearray(struct.pack('!BBHHH', 8, 0, 0, 1, 1))
+        echo[2:4] = struct.pack('H', tcping.get_checksum(bytes(echo)))
+        stop = threading.Event()
+
+        def ping():
+            while not stop.wait(0.02):
+                pinger.sendto(echo, ('127.0.0.1', 0))
+
+        thread = threading.Thread(target=ping)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+
+        writer = tcping.MemoryWriter()
+        session = tcping.Session('127.0.0.1', port, 2, 0.3, 0.01,
+                                 output=writer)
+        init_time = time.monotonic()
+        session.run()
+
+        self.assertLess(time.monotonic() - init_time, 2)
+        self.assertEqual(
+            [tcping.PORT_FILTERED] * 2, [res.state for res in writer.results])
+
+    def test_session_stop(self):
+        session = tcping.Session('127.0.0.1', self.open_port, interval=0.01,
+                                 output=tcping.MemoryWriter())
+        thread = threading.Thread(target=session.run)
+        thread.start()
+        time.sleep(0.1)
+        session.stop()
+        thread.join(2)
+
+        self.assertFalse(thread.is_alive())
+        self.assertGreater(session.stat.send, 0)
+        self.assertEqual(session.stat.send, session.stat.recv)
+
+
+class TestSweep(LoopbackTestCase):
+
+    def test_sweep(self):
+        open_port = self.listen()
+        closed_port = self.closed_port()
+
+        targets = [('127.0.0.1', open_port), ('127.0.0.1', closed_port)]
+        results = {(res.dst_ip, res.port): res.state for res in
+                   tcping.sweep(targets * 50, 0.5, 0.0001, 16)}
+
+        self.assertEqual({
+            ('127.0.0.1', open_port): tcping.PORT_OPEN,
+            ('127.0.0.1', closed_port): tcping.PORT_CLOSED,
+        }, results)
+
+    def test_ipv6_sweep(self):
+        open_port = self.listen('::1')
+        closed_port = self.closed_port('::1')
+
+        writer = tcping.MemoryWriter()
+        stat = tcping.start_sweep(
+            '::1/128', [(open_port, open_port), (closed_port, closed_port)],
+            0.5, 0.0001, 4, output=writer, mode=tcping.MODE_RAW)
+
+        self.assertEqual(2, stat.send)
+        self.assertEqual({
+            ('::1', open_port): tcping.PORT_OPEN,
+            ('::1', closed_port): tcping.PORT_CLOSED,
+        }, {(res.dst_ip, res.port): res.state for res in writer.results})
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                list(tcping.sweep([('::1', open_port)], 0.5, 0.0001, 4,
+                                  ring=True))
+
+    def test_sweep_ring(self):
+        open_port = self.listen()
+        closed_port = self.closed_port()
+
+        targets = [('127.0.0.1', open_port), ('127.0.0.1', closed_port)]
+        results = list(tcping.sweep(targets * 50, 0.5, 0.0001, 16, ring=True))
+
+        self.assertEqual(100, len(results))
+        self.assertEqual({
+            ('127.0.0.1', open_port): tcping.PORT_OPEN,
+            ('127.0.0.1', closed_port): tcping.PORT_CLOSED,
+        }, {(res.dst_ip, res.port): res.state for res in results})
+        self.assertTrue(all(0 <= res.rtt < 500000 for res in results))
+
+    def test_sharded_sweep(self):
+        open_port = self.listen('0.0.0.0')
+        closed_port = self.closed_port()
+
+        writer = tcping.MemoryWriter()
+        stages = tcping.StageStats()
+        stat = tcping.start_sweep(
+            '127.0.0.0/29', [(open_port, open_port),
+                             (closed_port, closed_port)],
+            0.5, 0.0001, 4, output=writer, stages=stages, workers=3)
+
+        self.assertEqual(12, stat.send)
+        self.assertEqual(6, stat.recv)
+        self.assertEqual(6, stat.count)
+        self.assertIs(stat, writer.stat)
+        self.assertEqual(12, len({(res.dst_ip, res.port)
+                                  for res in writer.results}))
+        self.assertTrue(all(res.ok == (res.port == open_port)
+                            for res in writer.results))
+        self.assertEqual(12, stages.counters['matched'])
+
+        ports = [set(tcping.shard_ports(shard, 3)) for shard in range(3)]
+        self.assertFalse(ports[0] & ports[1] or ports[1] & ports[2])
+
+    def test_sharded_sweep_host(self):
+        open_port = self.listen()
+        # pool threads are started in parent before workers fork
+        tcping.resolver.resolve('127.0.0.1')
+        tcping.resolver.clear()
+
+        writer = tcping.MemoryWriter()
+        stat = tcping.start_sweep(
+            'localhost', [(open_port, open_port + 1)], 0.5, 0.0001, 4,
+            output=writer, workers=2)
+
+        self.assertEqual(2, stat.send)
+        self.assertEqual({'127.0.0.1'},
+                         {res.dst_ip for res in writer.results})
+
+
+class TestRace(LoopbackTestCase):
+
+    def test_race(self):
+        listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        listener.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        listener.bind(('::', 0))
+        listener.listen(16)
+        port = listener.getsockname()[1]
+        self.addCleanup(listener.close)
+
+        results = list(tcping.race(['::1', '127.0.0.1'], port, 0.5))
+        self.assertEqual({'::1', '127.0.0.1'},
+                         {res.dst_ip for res in results})
+        self.assertTrue(all(res.ok and res.port == port
+                            for res in results))
+
+        results = tcping.race(['::1', '127.0.0.1'], self.silent_port(), 0.1)
+        self.assertEqual([('::1', tcping.PORT_CLOSED),
+                          ('127.0.0.1', tcping.PORT_FILTERED)],
+                         [(res.dst_ip, res.state) for res in results])
+
+    def test_race_rejects_sweep(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            with self.assertRaises(SystemExit) as cm:
+                tcping.main('localhost', [(22, 22), (80, 80)], 1, 0.5, 0.1,
+                            race=True)
+        self.assertEqual(2, cm.exception.code)
+        self.assertIn("can't sweep", out.getvalue())
+
+
+class TestConnectSweep(LoopbackTestCase):
+
+    def test_connect_sweep(self):
+        open_port = self.listen()
+        closed_port = self.closed_port()
+
+        targets = [('127.0.0.1', open_port), ('127.0.0.1', closed_port)]
+        results = list(tcping.connect_sweep(targets * 20, 0.5, 0.0001, 8))
+
+        self.assertEqual(40, len(results))
+        self.assertEqual({
+            ('127.0.0.1', open_port): tcping.PORT_OPEN,
+            ('127.0.0.1', closed_port): tcping.PORT_CLOSED,
+        }, {(res.dst_ip, res.port): res.state for res in results})
+        self.assertTrue(all(res.ok == (res.port == open_port)
+                            for res in results))
+
+    def test_connect_session(self):
+        open_port = self.listen()
+        session = tcping.Session(
+            '127.0.0.1', open_port, 20, 0.5, 0.001, 4,
+            output=tcping.MemoryWriter(), mode=tcping.MODE_CONNECT)
+        stat = session.run()
+
+        self.assertEqual(20, stat.send)
+        self.assertEqual(20, stat.recv)
+        self.assertEqual(list(range(1, 21)),
+                         sorted(res.seq_num for res in session.writer.results))
+
+
+class TestAsyncProbe(LoopbackTestCase):
+
+    def setUp(self):
+        self.open_port = self.listen(backlog=1024)
+
+    async def collect(self, port, count, **kwargs):
+        return [res async for res in tcping.probe(
+            '127.0.0.1', port, count=count, **kwargs)]
+
+    def test_concurrent_sessions(self):
+        closed_port = self.closed_port()
+
+        async def run():
+            sessions = [self.collect(self.open_port, 5, interval=0.01)
+                        for _ in range(100)]
+            sessions.append(self.collect(
+                closed_port, 3, interval=0.01, timeout=0.1, window=3))
+            return await asyncio.gather(*sessions)
+
+        *opened, closed = asyncio.run(run())
+
+        for results in opened:
+            self.assertEqual(5, len(results))
+            self.assertTrue(all(res.ok for res in results))
+        self.assertEqual([False] * 3, [res.ok for res in closed])
+        self.assertEqual({}, dict(tcping.AsyncProbeEngine.engines))
+
+    def test_early_exit(self):
+        async def run():
+            async with contextlib.aclosing(tcping.probe(
+                    '127.0.0.1', self.open_port, interval=0.01)) as results:
+                async for res in results:
+                    return res
+
+        self.assertTrue(asyncio.run(run()).ok)
+
+    def test_closed_port(self):
+        init_time = time.monotonic()
+        results = asyncio.run(self.collect(
+            self.closed_port(), 3, interval=0.01, timeout=5))
+
+        self.assertLess(time.monotonic() - init_time, 1)
+        self.assertEqual([tcping.PORT_CLOSED] * 3,
+                         [res.state for res in results])
+        self.assertTrue(all(res.rtt is not None for res in results))
+
+    def test_invalid_args(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(self.collect(self.open_port, -1))
+
+    def test_ipv6(self):
+        port = self.listen('::1')
+
+        async def run():
+            return [res async for res in tcping.probe(
+                '::1', port, count=3, interval=0.01)]
+
+        results = asyncio.run(run())
+        self.assertEqual([True] * 3, [res.ok for res in results])
+        self.assertEqual({}, dict(tcping.AsyncProbeEngine.engines))
+
+    def test_no_privileges(self):
+        error = PermissionError(1, 'Operation not permitted')
+        with mock.patch.object(tcping, 'open_raw_socket',
+                               side_effect=error):
+            with self.assertRaises(PermissionError):
+                asyncio.run(self.collect(self.open_port, 1))
+        self.assertEqual({}, dict(tcping.AsyncProbeEngine.engines))
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file